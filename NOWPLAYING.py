@@ -1,15 +1,32 @@
 import os
-import io
+import json
 import time
+import random
+import asyncio
+import sqlite3
+import hashlib
+import threading
 import discord
 import aiohttp 
-import requests
-import tempfile
 import urllib.parse
-from io import BytesIO
+import concurrent.futures
+import bisect
+import re
+import fnmatch
+import logging
+import cProfile
+import pstats
+from io import BytesIO, StringIO
+from collections import OrderedDict, defaultdict, Counter, deque
 from discord import Option
 from datetime import datetime, timedelta
-from discord.ext import tasks, commands
+from discord.ext import commands
+from aiohttp import web
+
+try:
+    from PIL import Image, ImageDraw, ImageFilter, ImageFont, ImageOps
+except ImportError:
+    Image = None  # Pillow is optional; without it artwork is only resized by Emby and cards fall back to messages
 
 
 # Discord bot token and Emby server details
@@ -17,7 +34,1713 @@ discord_bot_token = os.getenv('NOWPLAYING_DISCORD_BOT_TOKEN')
 emby_server_ip = '192.168.4.101'
 emby_server_port = '8096'
 api_key = os.getenv('EMBY_API_BOT_KEY')
-emby_thread_channel_id = int(os.getenv('EMBY_THREAD_CHANNEL'))  # Fetch the channel ID from environment variable
+emby_thread_channel_id = int(os.getenv('EMBY_THREAD_CHANNEL', '0'))  # Fetch the channel ID from environment variable (optional with NOWPLAYING_SERVERS)
+
+# More than one Emby server: NOWPLAYING_SERVERS names a JSON file listing them. Each server gets its own client,
+# poll cadence, watch/ignore lists, thread and state file; keys left out fall back to the settings in this file.
+#   [{"name": "home", "host": "192.168.4.101", "port": 8096, "api_key_env": "EMBY_API_BOT_KEY",
+#     "thread_channel_id": 1234, "watch": ["tim"], "ignore": ["adult"], "poll_active": 10}]
+# Without it the single server above is used, under the name 'default'.
+servers_config_path = os.getenv('NOWPLAYING_SERVERS')
+
+# Emby HTTP client settings
+emby_request_timeout = 10           # Seconds before a single Emby request is abandoned
+emby_max_concurrent_requests = 8    # Cap on requests in flight to the Emby server at once
+emby_connection_pool_size = 16      # Keep-alive connections held open to the Emby server
+emby_retry_attempts = 3             # Tries per Emby call, the first included; errors, timeouts and 5xx answers are retried
+emby_retry_base_delay = 0.5         # Seconds before the first retry, doubled for each one after, with full jitter
+emby_retry_max_delay = 5            # Upper bound for the delay between retries
+emby_breaker_failures = 5           # Consecutive failed calls that open a server's circuit
+emby_breaker_reset = 30             # Seconds an open circuit fails calls straight away before letting a trial call through
+# Seconds allowed for one call to an endpoint, retries included (longest matching prefix wins, else emby_request_timeout)
+emby_endpoint_deadlines = {
+    '/Sessions': 5,
+    '/emby/Items/{id}/Images': 8,
+}
+
+# /Sessions only lists sessions active within this many seconds (0 lists every session Emby knows, idle
+# devices included); 960 matches Emby's own dashboard and comfortably covers a long pause
+sessions_active_within = 960
+
+# Session ingestion: 'websocket' takes pushed session events from Emby and only polls while the socket is down,
+# 'poll' only polls /Sessions, on the adaptive interval set by poll_interval_min/active/max
+ingest_mode = os.getenv('NOWPLAYING_INGEST_MODE', 'websocket').lower()
+websocket_reconnect_delay = 5       # Seconds before the first reconnect attempt, doubled on each failure
+websocket_max_reconnect_delay = 60  # Upper bound for the reconnect delay
+websocket_keepalive_interval = 30   # Seconds between KeepAlive messages sent to Emby
+
+# Artwork cache settings
+artwork_cache_dir = os.getenv('NOWPLAYING_ARTWORK_CACHE_DIR', './cache/artwork')
+artwork_memory_cache_bytes = 64 * 1024 * 1024   # In-memory LRU size cap
+artwork_disk_cache_bytes = 512 * 1024 * 1024    # On-disk store size cap
+artwork_untagged_ttl = 3600                     # Seconds to keep images Emby gave no tag for (they can't invalidate themselves)
+
+# Artwork size targets per display slot: (max width in px, JPEG quality, max bytes before local recompression)
+artwork_slot_targets = {
+    'thumbnail': (320, 85, 150 * 1024),
+    'image': (1024, 85, 600 * 1024),
+    'backdrop': (1280, 80, 900 * 1024),
+}
+artwork_process_workers = 2  # Worker processes for local downscaling
+artwork_max_bytes = 16 * 1024 * 1024        # Largest image body accepted from Emby; bigger ones are abandoned mid-transfer
+artwork_inflight_bytes = 64 * 1024 * 1024   # Budget for image bodies being downloaded at once, across all users and servers
+artwork_chunk_bytes = 64 * 1024             # Read size while streaming an image body
+
+# Upload-once artwork: with NOWPLAYING_ARTWORK_CHANNEL set, each image is uploaded once to that channel and posts
+# reference its Discord CDN URL instead of attaching the bytes again. A dedicated channel is needed because an
+# attachment's URL stops working once the message carrying it is edited or deleted, and the bot's posts come and go.
+artwork_store_channel_id = int(os.getenv('NOWPLAYING_ARTWORK_CHANNEL', '0'))  # 0 attaches the artwork to every post
+artwork_store_capacity = 4096       # CDN URLs remembered; the least recently used are forgotten first
+artwork_url_margin = 3600           # Seconds before a signed URL expires that it is refreshed instead of handed out
+artwork_url_ttl = 20 * 3600         # Lifetime assumed for a URL that carries no expiry
+
+# Message layout: 'messages' posts the embed plus a separate image message per user,
+# 'card' composites the artwork and text into one image and posts a single message per user (needs Pillow),
+# 'dashboard' lists every active session as a field of one shared embed that is edited in place
+render_mode = os.getenv('NOWPLAYING_RENDER_MODE', 'messages').lower()
+card_size = (1024, 384)     # Card width and height in px
+card_quality = 85           # JPEG quality of the composited card
+card_font_path = os.getenv('NOWPLAYING_CARD_FONT', 'DejaVuSans.ttf')  # TrueType font for card text; Pillow's built-in font if not found
+dashboard_interval = float(os.getenv('NOWPLAYING_DASHBOARD_INTERVAL', '10'))  # At most one dashboard update per this many seconds
+dashboard_fields_per_page = 25      # Discord's field limit per embed
+dashboard_chars_per_page = 5500     # Discord allows 6000 characters per embed; leave room for the title
+
+# Series folder.jpg lookups on the library share
+series_artwork_ttl = 600            # Seconds to trust a found folder.jpg before checking the share again
+series_artwork_negative_ttl = 120   # Seconds to remember a missing folder.jpg or an unreachable share
+series_artwork_timeout = 3          # Seconds before a stat/read on the share counts as unreachable
+series_artwork_workers = 4          # Threads doing filesystem calls on the share
+
+# Bot presence: one session's text wins the status. Users listed in NOWPLAYING_PRESENCE_USERS win first (in that
+# order), then media types in NOWPLAYING_PRESENCE_PRIORITY order, then whoever has been playing longest
+presence_user_priority = [user for user in os.getenv('NOWPLAYING_PRESENCE_USERS', '').lower().split(',') if user]
+presence_media_priority = os.getenv('NOWPLAYING_PRESENCE_PRIORITY', 'movie,episode,musicvideo,audio,audiobook').lower().split(',')
+presence_rate_limit = (5, 20.0)  # Presence updates allowed per seconds on the gateway; changes in between are coalesced
+
+# Adaptive poll scheduling (seconds): polls run at the active interval while a watched user is playing
+# and back off towards the maximum while idle; an extra poll is scheduled just after a playing item should end
+poll_interval_min = float(os.getenv('NOWPLAYING_POLL_MIN', '2'))
+poll_interval_active = float(os.getenv('NOWPLAYING_POLL_ACTIVE', '10'))
+poll_interval_max = float(os.getenv('NOWPLAYING_POLL_MAX', '120'))
+poll_idle_backoff = 2.0     # Multiplier applied to the interval after each idle poll
+poll_end_margin = 1.5       # Seconds after an item's predicted end to poll for the next one
+
+# Local artist index behind /q_artist autocomplete
+artist_index_page_size = 500            # Artists fetched per request while syncing
+artist_index_sync_interval = 900        # Seconds between incremental syncs (MinDateLastSaved deltas)
+artist_index_full_sync_interval = 86400 # Seconds between full resyncs, which also drop deleted artists
+
+# Play history: every item a watched user starts is appended to a local JSON-lines log, and /history and /top
+# answer from an in-memory index of the most recent entries
+history_log_path = os.getenv('NOWPLAYING_HISTORY_LOG', './nowplaying_history.jsonl')
+history_flush_interval = 5              # Seconds between batched writes to the log (one fsync per batch)
+history_flush_batch = 200               # Queued records that trigger a write before the interval is up
+history_index_per_user = 1000           # Most recent plays kept in memory per user and server
+history_index_days = 90                 # Plays older than this are left out of the in-memory index
+history_max_bytes = 64 * 1024 * 1024    # Log size at which it is moved aside to <log>.1 and a new one started
+
+# Local state store, so a restart picks up the messages already in the thread
+state_db_path = os.getenv('NOWPLAYING_STATE_DB', './nowplaying_state.sqlite3')
+
+# Messages older than this can't be bulk deleted by Discord (the hard limit is 14 days)
+bulk_delete_max_age = timedelta(days=14) - timedelta(minutes=10)
+
+# Outbound Discord queue settings
+discord_debounce_window = float(os.getenv('NOWPLAYING_DEBOUNCE_SECONDS', '2'))  # Changes arriving within this window are posted together
+# Local mirror of Discord's per-channel rate-limit buckets: operation -> (requests, per seconds)
+discord_rate_limits = {
+    'send': (5, 5.0),
+    'edit': (5, 5.0),
+    'delete': (5, 1.0),
+    'fetch': (5, 1.0),
+}
+
+
+# Logging, metrics and profiling
+log_level = os.getenv('NOWPLAYING_LOG_LEVEL', 'INFO').upper()
+log_format = os.getenv('NOWPLAYING_LOG_FORMAT', 'text').lower()  # 'text' for key=value lines, 'json' for one object per line
+metrics_host = os.getenv('NOWPLAYING_METRICS_HOST', '127.0.0.1')
+metrics_port = int(os.getenv('NOWPLAYING_METRICS_PORT', '9464'))  # Prometheus /metrics endpoint; 0 turns it off
+metrics_buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)  # Histogram bucket bounds in seconds
+profile_every_polls = int(os.getenv('NOWPLAYING_PROFILE_EVERY', '0'))  # Run every Nth poll under cProfile; 0 turns it off
+profile_dir = os.getenv('NOWPLAYING_PROFILE_DIR')  # Also dump each profile here as a .pstats file, if set
+profile_top_functions = 20  # Functions listed in the logged profile summary
+
+log = logging.getLogger('nowplaying')
+
+
+class StructuredFormatter(logging.Formatter):
+    # Renders a record's extra= fields after the message, either as key=value pairs or as one JSON object
+    reserved = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+    def __init__(self, output='text'):
+        super().__init__('%(asctime)s %(levelname)s %(name)s: %(message)s')
+        self.output = output
+
+    def format(self, record):
+        fields = {key: value for key, value in vars(record).items() if key not in self.reserved}
+        if self.output == 'json':
+            entry = {'time': self.formatTime(record), 'level': record.levelname, 'logger': record.name, 'message': record.getMessage()}
+            entry.update(fields)
+            if record.exc_info:
+                entry['exception'] = self.formatException(record.exc_info)
+            return json.dumps(entry, default=str)
+        line = super().format(record)
+        if fields:
+            line += ' ' + ' '.join(f'{key}={value!r}' if isinstance(value, str) and ' ' in value else f'{key}={value}'
+                                   for key, value in fields.items())
+        return line
+
+
+def configure_logging():
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(log_format))
+    log.addHandler(handler)
+    log.setLevel(log_level)
+    log.propagate = False
+
+
+class Metrics:
+    # Counters and histograms for the hot paths, served in the Prometheus text format on /metrics.
+    # Series are keyed on (name, label pairs); gauges are callbacks read at scrape time.
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.descriptions = {}  # name -> (type, help)
+        self.counters = defaultdict(float)  # (name, labels) -> value
+        self.histograms = {}  # (name, labels) -> [per-bucket counts..., +Inf count, sum]
+        self.gauges = {}  # name -> callback returning {labels: value}
+
+    def describe(self, name, kind, help_text):
+        self.descriptions[name] = (kind, help_text)
+
+    def inc(self, name, amount=1, **labels):
+        self.counters[(name, tuple(sorted(labels.items())))] += amount
+
+    def observe(self, name, seconds, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        series = self.histograms.get(key)
+        if series is None:
+            series = self.histograms[key] = [0] * (len(self.buckets) + 1) + [0.0]
+        series[bisect.bisect_left(self.buckets, seconds)] += 1
+        series[-1] += seconds
+
+    def timer(self, name, **labels):
+        return MetricsTimer(self, name, labels)
+
+    def gauge(self, name, help_text, callback):
+        self.describe(name, 'gauge', help_text)
+        self.gauges[name] = callback
+
+    def render(self):
+        lines = []
+        by_name = defaultdict(list)
+        for (name, labels), value in self.counters.items():
+            by_name[name].append((labels, value))
+        for (name, labels), series in self.histograms.items():
+            by_name[name].append((labels, series))
+        for name, callback in self.gauges.items():
+            try:
+                by_name[name].extend((tuple(sorted(labels)), value) for labels, value in callback().items())
+            except Exception as e:
+                log.warning("Metrics gauge failed", extra={'metric': name, 'error': repr(e)})
+
+        for name in sorted(by_name):
+            kind, help_text = self.descriptions.get(name, ('untyped', ''))
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, value in sorted(by_name[name], key=lambda entry: entry[0]):
+                if kind != 'histogram':
+                    lines.append(f'{name}{format_labels(labels)} {value}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(self.buckets + ('+Inf',), value[:-1]):
+                    cumulative += count
+                    lines.append(f'{name}_bucket{format_labels(labels + (("le", str(bound)),))} {cumulative}')
+                lines.append(f'{name}_sum{format_labels(labels)} {value[-1]}')
+                lines.append(f'{name}_count{format_labels(labels)} {cumulative}')
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsTimer:
+    # with metrics.timer('name', label=...) - records the block's wall time, including time spent awaiting
+    def __init__(self, metrics, name, labels):
+        self.metrics = metrics
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.metrics.observe(self.name, time.perf_counter() - self.started, **self.labels)
+        return False
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in labels)
+    return '{' + ','.join(f'{key}="{value}"' for (key, _), value in zip(labels, escaped)) + '}'
+
+
+metrics = Metrics(metrics_buckets)
+metrics.describe('nowplaying_emby_request_seconds', 'histogram', 'Emby HTTP request latency by endpoint')
+metrics.describe('nowplaying_emby_requests_total', 'counter', 'Emby HTTP requests by endpoint and status')
+metrics.describe('nowplaying_poll_seconds', 'histogram', 'Time for a full /Sessions poll including dispatch')
+metrics.describe('nowplaying_polls_total', 'counter', 'Polls by result')
+metrics.describe('nowplaying_sessions_unchanged_total', 'counter', 'Session updates skipped because nothing watched had changed')
+metrics.describe('nowplaying_artwork_fetch_seconds', 'histogram', 'Artwork fetch latency by source')
+metrics.describe('nowplaying_discord_request_seconds', 'histogram', 'Discord request latency by operation, excluding rate-limit waits')
+metrics.describe('nowplaying_discord_requests_total', 'counter', 'Discord requests by operation and result')
+metrics.describe('nowplaying_handler_seconds', 'histogram', 'Per-user media handler time by media type')
+metrics.describe('nowplaying_handler_errors_total', 'counter', 'Media handler failures by media type')
+metrics.describe('nowplaying_artwork_store_total', 'counter', 'Artwork CDN URL lookups by result (reused, uploaded, refreshed, failed)')
+metrics.describe('nowplaying_emby_retries_total', 'counter', 'Emby calls retried after an error, timeout or 5xx answer')
+metrics.describe('nowplaying_card_render_seconds', 'histogram', 'Time to composite a now-playing card')
+
+
+class EmbyUnavailable(Exception):
+    # Raised instead of calling Emby while the server's circuit is open
+    pass
+
+
+class CircuitBreaker:
+    # One per Emby server. 'closed' lets every call through; after `threshold` consecutive failed calls it opens
+    # and fails calls straight away for `reset` seconds, then goes 'half_open' and lets one trial call through.
+    # The trial closes the circuit if it succeeds and reopens it if it fails; a trial that never reports back
+    # (its task was cancelled) is replaced by a new one after another `reset` seconds.
+    def __init__(self, name, threshold, reset):
+        self.name = name
+        self.threshold = threshold
+        self.reset = reset
+        self.state = 'closed'
+        self.failures = 0
+        self.opened_at = None
+        self.trial_started = None
+
+    def check(self):
+        now = time.monotonic()
+        if self.state == 'open':
+            if now - self.opened_at < self.reset:
+                raise EmbyUnavailable(f"Emby server '{self.name}' is unavailable")
+            self.state = 'half_open'
+            self.trial_started = None
+        if self.state == 'half_open':
+            if self.trial_started is not None and now - self.trial_started < self.reset:
+                raise EmbyUnavailable(f"Emby server '{self.name}' is unavailable")
+            self.trial_started = now
+
+    def succeeded(self):
+        if self.state != 'closed':
+            log.info("Emby circuit closed", extra={'server': self.name})
+        self.state = 'closed'
+        self.failures = 0
+        self.trial_started = None
+
+    def failed(self):
+        self.failures += 1
+        if self.state == 'half_open' or (self.state == 'closed' and self.failures >= self.threshold):
+            if self.state == 'closed':
+                log.warning("Emby circuit opened", extra={'server': self.name, 'failures': self.failures})
+            self.state = 'open'
+            self.opened_at = time.monotonic()
+            self.trial_started = None
+
+
+class EmbyClient:
+    # Shared async client used for every Emby call. It keeps one long-lived aiohttp session so
+    # connections are reused between polls and the event loop is never blocked waiting on Emby.
+    def __init__(self, server_ip, server_port, api_key, timeout=emby_request_timeout,
+                 max_concurrent=emby_max_concurrent_requests, pool_size=emby_connection_pool_size, name='default'):
+        self.name = name
+        self.base_url = f'http://{server_ip}:{server_port}'
+        self.api_key = api_key
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self.pool_size = pool_size
+        self.semaphore = asyncio.Semaphore(max_concurrent)
+        self.breaker = CircuitBreaker(name, emby_breaker_failures, emby_breaker_reset)
+        self.session = None
+
+    def get_session(self):
+        # The session must be created inside the running event loop, so it is opened lazily
+        if self.session is None or self.session.closed:
+            connector = aiohttp.TCPConnector(limit=self.pool_size, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(
+                base_url=self.base_url,
+                connector=connector,
+                timeout=self.timeout,
+                headers={'X-Emby-Token': self.api_key},
+            )
+        return self.session
+
+    def url(self, path, **params):
+        # Full URL for places where Discord itself loads the image, so the key has to be in the query
+        params['api_key'] = self.api_key
+        return f"{self.base_url}{path}?{urllib.parse.urlencode(params)}"
+
+    def deadline(self, endpoint):
+        prefix = max((prefix for prefix in emby_endpoint_deadlines if endpoint.startswith(prefix)), key=len, default=None)
+        return emby_endpoint_deadlines[prefix] if prefix else emby_request_timeout
+
+    async def request(self, path, params, timeout, read, failed):
+        # One logical GET under the circuit breaker. Its attempts share one deadline (the endpoint's, unless the
+        # caller gives one); connection errors, timeouts and 5xx answers are retried with jittered exponential
+        # backoff while the deadline allows. read(response, endpoint) turns any other answer into the result and
+        # failed(status) is returned if Emby still answers 5xx at the end. Raises EmbyUnavailable while the
+        # circuit is open, and the last error if Emby never answered.
+        endpoint = endpoint_label(path)
+        self.breaker.check()
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (timeout or self.deadline(endpoint))
+        error = asyncio.TimeoutError()
+        status = None
+        for attempt in range(emby_retry_attempts):
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                break
+            try:
+                async with self.semaphore:
+                    with metrics.timer('nowplaying_emby_request_seconds', server=self.name, endpoint=endpoint):
+                        async with self.get_session().get(path, params=params, timeout=aiohttp.ClientTimeout(total=remaining)) as response:
+                            if response.status < 500:
+                                result = await read(response, endpoint)
+                                self.breaker.succeeded()
+                                return result
+                            status = response.status
+                            metrics.inc('nowplaying_emby_requests_total', server=self.name, endpoint=endpoint, status=status)
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                metrics.inc('nowplaying_emby_requests_total', server=self.name, endpoint=endpoint, status='error')
+                error, status = e, None
+
+            delay = random.uniform(0, min(emby_retry_max_delay, emby_retry_base_delay * 2 ** attempt))
+            if attempt + 1 == emby_retry_attempts or loop.time() + delay >= deadline:
+                break
+            metrics.inc('nowplaying_emby_retries_total', server=self.name, endpoint=endpoint)
+            await asyncio.sleep(delay)
+
+        self.breaker.failed()
+        if status is not None:
+            return failed(status)
+        raise error
+
+    async def get_json(self, path, params=None, timeout=None):
+        # Returns (status, data); data is None unless Emby answered with 200
+        return await self.request(path, params, timeout, self.read_json, lambda status: (status, None))
+
+    async def read_json(self, response, endpoint):
+        metrics.inc('nowplaying_emby_requests_total', server=self.name, endpoint=endpoint, status=response.status)
+        if response.status != 200:
+            return response.status, None
+        return response.status, await response.json(content_type=None)
+
+    async def get_bytes(self, path, params=None, timeout=None, max_bytes=artwork_max_bytes, budget=None):
+        # Returns the response body, or None if the image is missing, too large or Emby can't be reached.
+        # The body is streamed in chunks and abandoned as soon as it passes max_bytes. With a budget, max_bytes
+        # is reserved before the request takes one of the client's connection slots, so a download waiting on
+        # the budget never holds up other Emby calls; once Content-Length is known the reservation shrinks to
+        # it. The budget covers downloads only: a finished body is released, and whatever keeps it afterwards
+        # (the artwork cache, a queued or prefetched view) is bounded by its own limits.
+        reserved = max_bytes
+
+        async def read(response, endpoint):
+            nonlocal reserved
+            if response.status != 200:
+                metrics.inc('nowplaying_emby_requests_total', server=self.name, endpoint=endpoint, status=response.status)
+                return None
+            size = response.content_length
+            if size is not None and size > max_bytes:
+                return self.reject(path, endpoint, size)
+            limit = size if size is not None else max_bytes
+            if budget is not None and limit != reserved:
+                # Normally a shrink; a retry that gets a different answer than an earlier attempt can grow it back
+                if limit < reserved:
+                    await budget.release(reserved - limit)
+                else:
+                    await budget.acquire(limit - reserved)
+                reserved = limit
+            chunks = []
+            received = 0
+            async for chunk in response.content.iter_chunked(artwork_chunk_bytes):
+                received += len(chunk)
+                if received > limit:
+                    return self.reject(path, endpoint, received)
+                chunks.append(chunk)
+            metrics.inc('nowplaying_emby_requests_total', server=self.name, endpoint=endpoint, status=response.status)
+            return b''.join(chunks)
+
+        if budget is not None:
+            await budget.acquire(reserved)
+        try:
+            return await self.request(path, params, timeout, read, lambda status: None)
+        except EmbyUnavailable:
+            return None  # Already logged when the circuit opened
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            log.warning("Failed to fetch from Emby", extra={'server': self.name, 'path': path, 'error': repr(e)})
+            return None
+        finally:
+            if budget is not None:
+                await budget.release(reserved)
+
+    def reject(self, path, endpoint, size):
+        metrics.inc('nowplaying_emby_requests_total', server=self.name, endpoint=endpoint, status='too_large')
+        log.warning("Image from Emby is too large, skipping it", extra={'server': self.name, 'path': path, 'bytes': size})
+        return None
+
+    def websocket(self, device_id='nowplaying-bot'):
+        # Emby's push channel; the API key has to go in the query string for the upgrade request
+        params = {'api_key': self.api_key, 'deviceId': device_id}
+        return self.get_session().ws_connect('/embywebsocket', params=params, heartbeat=websocket_keepalive_interval)
+
+    def cache_key(self, item_id):
+        # Item IDs are only unique within one server, so cached artwork is namespaced by server
+        return item_id if self.name == 'default' else f'{self.name}/{item_id}'
+
+    async def close(self):
+        if self.session is not None and not self.session.closed:
+            await self.session.close()
+
+
+class ByteBudget:
+    # Counting semaphore over bytes rather than requests. Each transfer reserves its size up front and waits
+    # while the reservations already in flight would push the total past the limit; a reservation larger than
+    # the whole budget is still let through once nothing else is in flight, so it can't wait forever. Part of
+    # a reservation can be handed back early with release() once the transfer knows it needs less.
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self.condition = asyncio.Condition()
+
+    async def acquire(self, size):
+        async with self.condition:
+            await self.condition.wait_for(lambda: self.in_use == 0 or self.in_use + size <= self.limit)
+            self.in_use += size
+
+    async def release(self, size):
+        async with self.condition:
+            self.in_use -= size
+            self.condition.notify_all()
+
+
+artwork_budget = ByteBudget(artwork_inflight_bytes)
+
+
+def endpoint_label(path):
+    # Metric label for an Emby path with the IDs taken out: /Users/<id>/Items/<id> -> /Users/{id}/Items/{id}
+    parts = path.split('/')
+    for index in range(1, len(parts)):
+        if parts[index - 1] in ('Users', 'Items'):
+            parts[index] = '{id}'
+    return '/'.join(parts)
+
+
+
+class ArtworkCache:
+    # Two-tier image cache keyed on (item_id, image_type, tag). Emby changes the ImageTags tag whenever an
+    # image changes, so a new tag is simply a new key and stale entries age out of the LRU on their own.
+    # The memory tier is an LRU capped by total bytes; the disk tier stores each image once under its
+    # SHA-256 digest and evicts the least recently used keys when it grows past its cap.
+    def __init__(self, cache_dir, memory_limit, disk_limit, untagged_ttl):
+        self.cache_dir = cache_dir
+        self.index_path = os.path.join(cache_dir, 'index.json')
+        self.memory_limit = memory_limit
+        self.disk_limit = disk_limit
+        self.untagged_ttl = untagged_ttl
+        self.memory = OrderedDict()  # key -> (image bytes, stored_at)
+        self.memory_bytes = 0
+        self.index = None  # key string -> {'digest', 'size', 'stored_at', 'used_at'}, loaded on first disk access
+        self.disk_lock = threading.Lock()
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+    def is_expired(self, key, stored_at):
+        return key[2] is None and time.time() - stored_at > self.untagged_ttl
+
+    async def get(self, key):
+        entry = self.memory.get(key)
+        if entry is not None and not self.is_expired(key, entry[1]):
+            self.memory.move_to_end(key)
+            self.memory_hits += 1
+            return entry[0]
+
+        # Disk reads happen in a worker thread so a slow disk never stalls the event loop
+        data, stored_at = await asyncio.to_thread(self.read_disk, key)
+        if data is not None:
+            self.disk_hits += 1
+            self.remember(key, data, stored_at)
+            return data
+
+        self.misses += 1
+        return None
+
+    async def put(self, key, data):
+        stored_at = time.time()
+        self.remember(key, data, stored_at)
+        try:
+            await asyncio.to_thread(self.write_disk, key, data, stored_at)
+        except OSError as e:
+            log.warning("Failed to write artwork to disk cache", extra={'error': str(e)})
+
+    def remember(self, key, data, stored_at):
+        if len(data) > self.memory_limit:
+            return
+        old = self.memory.pop(key, None)
+        if old is not None:
+            self.memory_bytes -= len(old[0])
+        self.memory[key] = (data, stored_at)
+        self.memory_bytes += len(data)
+        while self.memory_bytes > self.memory_limit:
+            _, (evicted, _) = self.memory.popitem(last=False)
+            self.memory_bytes -= len(evicted)
+
+    def stats(self):
+        return {
+            'memory_hits': self.memory_hits,
+            'disk_hits': self.disk_hits,
+            'misses': self.misses,
+            'memory_entries': len(self.memory),
+            'memory_bytes': self.memory_bytes,
+        }
+
+    # --- Disk tier, only ever called from worker threads ---
+
+    def key_string(self, key):
+        return '|'.join('' if part is None else str(part) for part in key)
+
+    def blob_path(self, digest):
+        return os.path.join(self.cache_dir, digest[:2], digest)
+
+    def load_index(self):
+        if self.index is None:
+            try:
+                with open(self.index_path, 'r', encoding='utf-8') as f:
+                    self.index = json.load(f)
+            except (OSError, ValueError):
+                self.index = {}
+
+    def save_index(self):
+        os.makedirs(self.cache_dir, exist_ok=True)
+        temp_path = self.index_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.index, f)
+        os.replace(temp_path, self.index_path)
+
+    def read_disk(self, key):
+        with self.disk_lock:
+            self.load_index()
+            entry = self.index.get(self.key_string(key))
+            if entry is None or self.is_expired(key, entry['stored_at']):
+                return None, None
+            try:
+                with open(self.blob_path(entry['digest']), 'rb') as f:
+                    data = f.read()
+            except OSError:
+                del self.index[self.key_string(key)]
+                return None, None
+            entry['used_at'] = time.time()
+            return data, entry['stored_at']
+
+    def write_disk(self, key, data, stored_at):
+        digest = hashlib.sha256(data).hexdigest()
+        path = self.blob_path(digest)
+        with self.disk_lock:
+            self.load_index()
+            # Content addressed: the same cover shared by many keys is only stored once
+            if not os.path.exists(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                temp_path = path + '.tmp'
+                with open(temp_path, 'wb') as f:
+                    f.write(data)
+                os.replace(temp_path, path)
+            self.index[self.key_string(key)] = {'digest': digest, 'size': len(data), 'stored_at': stored_at, 'used_at': time.time()}
+            self.evict_disk()
+            self.save_index()
+
+    def evict_disk(self):
+        sizes = {entry['digest']: entry['size'] for entry in self.index.values()}
+        total = sum(sizes.values())
+        if total <= self.disk_limit:
+            return
+        for key_string, entry in sorted(self.index.items(), key=lambda kv: kv[1]['used_at']):
+            if total <= self.disk_limit:
+                break
+            del self.index[key_string]
+            digest = entry['digest']
+            # Only remove the blob once no remaining key points at it
+            if not any(other['digest'] == digest for other in self.index.values()):
+                total -= sizes[digest]
+                try:
+                    os.remove(self.blob_path(digest))
+                except OSError:
+                    pass
+
+
+artwork_cache = ArtworkCache(artwork_cache_dir, artwork_memory_cache_bytes, artwork_disk_cache_bytes, artwork_untagged_ttl)
+
+
+artwork_process_pool = None
+
+
+def downscale_artwork(data, max_width, quality):
+    # Runs in a worker process, so the decode/resize/encode never touches the event loop
+    with Image.open(BytesIO(data)) as image:
+        if image.mode != 'RGB':
+            image = image.convert('RGB')
+        if image.width > max_width:
+            height = max(1, round(image.height * max_width / image.width))
+            image = image.resize((max_width, height), Image.LANCZOS)
+        output = BytesIO()
+        image.save(output, format='JPEG', quality=quality, optimize=True)
+    result = output.getvalue()
+    return result if len(result) < len(data) else data
+
+
+def load_card_font(size):
+    try:
+        return ImageFont.truetype(card_font_path, size)
+    except OSError:
+        try:
+            return ImageFont.load_default(size)
+        except TypeError:  # Pillow < 10.1 has no sizes for the built-in font
+            return ImageFont.load_default()
+
+
+def wrap_card_text(draw, text, font, width, max_lines):
+    lines = []
+    for paragraph in text.split('\n'):
+        line = ''
+        for word in paragraph.split():
+            candidate = f'{line} {word}'.strip()
+            if line and draw.textlength(candidate, font=font) > width:
+                lines.append(line)
+                line = word
+            else:
+                line = candidate
+        lines.append(line)
+    if len(lines) > max_lines:
+        lines = lines[:max_lines]
+        lines[-1] = lines[-1].rstrip('.') + '\u2026'
+    return lines
+
+
+def compose_card(title, text, poster, background, size, quality):
+    # Runs in a worker process: blurred, darkened background art, the poster/cover on the left and the
+    # title and details on the right, encoded as one JPEG
+    width, height = size
+    margin = height // 12
+    card = Image.new('RGB', size, (24, 26, 32))
+    if background:
+        with Image.open(BytesIO(background)) as image:
+            # Blur a small copy and scale it up; the result looks the same and is much cheaper
+            backdrop = ImageOps.fit(image.convert('RGB'), (width // 4, height // 4)).filter(ImageFilter.GaussianBlur(3))
+        card = Image.blend(backdrop.resize(size, Image.BILINEAR), card, 0.55)
+
+    text_left = margin
+    if poster:
+        with Image.open(BytesIO(poster)) as image:
+            art = image.convert('RGB')
+            art.thumbnail((width // 3, height - 2 * margin), Image.LANCZOS)
+        card.paste(art, (margin, (height - art.height) // 2))
+        text_left = margin * 2 + art.width
+
+    draw = ImageDraw.Draw(card)
+    text_width = width - text_left - margin
+    title_font = load_card_font(height // 10)
+    body_font = load_card_font(height // 16)
+    y = margin
+    for line in wrap_card_text(draw, title, title_font, text_width, 2):
+        draw.text((text_left, y), line, font=title_font, fill=(255, 255, 255))
+        y += round(height / 10 * 1.25)
+    y += margin // 2
+    body_line_height = round(height / 16 * 1.4)
+    for line in wrap_card_text(draw, text, body_font, text_width, max(1, (height - margin - y) // body_line_height)):
+        draw.text((text_left, y), line, font=body_font, fill=(220, 220, 220))
+        y += body_line_height
+
+    output = BytesIO()
+    card.save(output, format='JPEG', quality=quality, optimize=True)
+    return output.getvalue()
+
+
+def get_artwork_process_pool():
+    global artwork_process_pool
+
+    if artwork_process_pool is None:
+        artwork_process_pool = concurrent.futures.ProcessPoolExecutor(max_workers=artwork_process_workers)
+    return artwork_process_pool
+
+
+async def shrink_artwork(data, max_width, quality):
+    if Image is None:
+        return data
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_artwork_process_pool(), downscale_artwork, data, max_width, quality)
+    except Exception as e:
+        log.warning("Failed to downscale artwork, uploading original", extra={'error': repr(e)})
+        return data
+
+
+def artwork_key(emby, item_id, image_type, tag, slot):
+    # Identifies a tagged Emby image as fetched for a slot; untagged images can change, so they get no key
+    return (emby.cache_key(item_id), image_type, tag, slot) if tag else None
+
+
+async def fetch_artwork(emby, item_id, image_type, tag=None, slot='image'):
+    # image_type is the path segment after /Images/, e.g. 'Primary' or 'Backdrop/0';
+    # slot picks the size target for where the image is shown
+    with metrics.timer('nowplaying_artwork_fetch_seconds', source='cache'):
+        key = (emby.cache_key(item_id), image_type, tag, slot)
+        data = await artwork_cache.get(key)
+    if data is not None:
+        return data
+
+    with metrics.timer('nowplaying_artwork_fetch_seconds', source='emby'):
+        return await download_artwork(emby, item_id, key)
+
+
+async def download_artwork(emby, item_id, key):
+    _, image_type, tag, slot = key
+
+    # Ask Emby for an image already sized for the slot, so the full resolution original never crosses the wire
+    max_width, quality, max_bytes = artwork_slot_targets[slot]
+    params = {'maxWidth': max_width, 'quality': quality}
+    if tag:
+        params['tag'] = tag
+    data = await emby.get_bytes(f'/emby/Items/{item_id}/Images/{image_type}', params=params, budget=artwork_budget)
+    if not data:
+        return data
+
+    # Some Emby versions ignore the size hints for certain images, so fall back to recompressing locally
+    if len(data) > max_bytes:
+        data = await shrink_artwork(data, max_width, quality)
+
+    await artwork_cache.put(key, data)
+    return data
+
+
+async def no_artwork():
+    # Stand-in for a fetch that has nothing to fetch, so optional images can still be gathered together
+    return None
+
+
+class SeriesArtworkResolver:
+    # Finds folder.jpg in a show's directory on the (often SMB/NFS mounted) library. Filesystem calls run
+    # in a small thread pool under a deadline, and each directory's outcome - found, missing or unreachable -
+    # is cached with a TTL, so a cold share is touched once per TTL instead of on every episode.
+    # The image bytes themselves go through the artwork cache, keyed on the file's mtime.
+    def __init__(self, ttl, negative_ttl, timeout, workers):
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+        self.timeout = timeout
+        self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix='series-artwork')
+        self.entries = {}  # show_directory -> (expires_at, mtime, state)
+        self.lookups = {}  # show_directory -> in-flight lookup shared by concurrent callers
+
+    async def run(self, function, *args):
+        loop = asyncio.get_running_loop()
+        return await asyncio.wait_for(loop.run_in_executor(self.executor, function, *args), self.timeout)
+
+    def remember(self, show_directory, mtime, state):
+        ttl = self.ttl if state == 'found' else self.negative_ttl
+        self.entries[show_directory] = (time.monotonic() + ttl, mtime, state)
+
+    async def lookup(self, show_directory):
+        entry = self.entries.get(show_directory)
+        if entry and entry[0] > time.monotonic():
+            return entry[1], entry[2]
+
+        task = self.lookups.get(show_directory)
+        if task is None:
+            task = asyncio.ensure_future(self.stat_folder_image(show_directory))
+            self.lookups[show_directory] = task
+            task.add_done_callback(lambda _: self.lookups.pop(show_directory, None))
+        return await asyncio.shield(task)
+
+    async def stat_folder_image(self, show_directory):
+        try:
+            mtime, state = await self.run(stat_file, os.path.join(show_directory, 'folder.jpg'))
+        except (OSError, asyncio.TimeoutError) as e:
+            log.warning("Library share unreachable", extra={'directory': show_directory, 'error': repr(e)})
+            mtime, state = None, 'unreachable'
+        self.remember(show_directory, mtime, state)
+        return mtime, state
+
+    async def fetch(self, show_directory):
+        # Returns (image bytes or None, 'found' / 'missing' / 'unreachable')
+        mtime, state = await self.lookup(show_directory)
+        if state != 'found':
+            return None, state
+
+        key = (show_directory, 'folder.jpg', mtime, 'thumbnail')
+        data = await artwork_cache.get(key)
+        if data is None:
+            try:
+                data = await self.run(read_file, os.path.join(show_directory, 'folder.jpg'))
+            except (OSError, asyncio.TimeoutError) as e:
+                log.warning("Failed to read folder.jpg", extra={'directory': show_directory, 'error': repr(e)})
+                self.remember(show_directory, None, 'unreachable')
+                return None, 'unreachable'
+            max_width, quality, max_bytes = artwork_slot_targets['thumbnail']
+            if len(data) > max_bytes:
+                data = await shrink_artwork(data, max_width, quality)
+            await artwork_cache.put(key, data)
+        return data, state
+
+
+def stat_file(path):
+    # Runs in a resolver thread; a missing file is an answer, any other OSError means the share is unreachable
+    try:
+        return os.stat(path).st_mtime, 'found'
+    except FileNotFoundError:
+        return None, 'missing'
+
+
+def read_file(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+series_artwork_resolver = SeriesArtworkResolver(series_artwork_ttl, series_artwork_negative_ttl, series_artwork_timeout, series_artwork_workers)
+
+
+async def fetch_series_thumbnail(item, emby):
+    # The show's folder.jpg from the library share, Emby's own Series image if the share can't be reached,
+    # and Series_Missing.jpg otherwise
+    item_path = item.get('Path')
+    if item_path:
+        show_directory = os.path.dirname(os.path.dirname(item_path))  # Go up two levels to get to the show directory
+        data, state = await series_artwork_resolver.fetch(show_directory)
+        if data:
+            return ('folder_image.jpg', data)
+    else:
+        state = 'unreachable'
+
+    if state == 'unreachable' and item.get('SeriesId'):
+        data = await fetch_artwork(emby, item['SeriesId'], 'Primary', item.get('SeriesPrimaryImageTag'), slot='thumbnail')
+        if data:
+            return ('series_image.jpg', data)
+
+    return ('Series_Missing.jpg', load_asset('Series_Missing.jpg'))
+
+
+class RateLimitBucket:
+    # Token bucket mirroring one Discord rate-limit bucket, so requests are spaced out locally instead of
+    # running into 429s and the library's retry backoff
+    def __init__(self, limit, per):
+        self.limit = limit
+        self.per = per
+        self.tokens = limit
+        self.updated = time.monotonic()
+        self.blocked_until = 0
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                if now < self.blocked_until:
+                    await asyncio.sleep(self.blocked_until - now)
+                    continue
+                self.tokens = min(self.limit, self.tokens + (now - self.updated) * self.limit / self.per)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * self.per / self.limit)
+
+    def block(self, seconds):
+        # Discord told us to back off; nothing goes out on this bucket until the retry window has passed
+        self.tokens = 0
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+
+class DiscordOutbox:
+    # Outbound scheduler for one thread. Work is queued per slot (a username, or 'nothing' for the global
+    # idle post) and only the latest operation for a slot is kept, so skipping through a playlist posts
+    # just the track that ends up playing. Queued work is flushed once the debounce window has passed,
+    # and every send/edit/delete waits on its rate-limit bucket.
+    def __init__(self, thread, registry, debounce=discord_debounce_window):
+        self.thread = thread
+        self.registry = registry  # MessageRegistry of the server this thread belongs to
+        self.debounce = debounce
+        self.buckets = {operation: RateLimitBucket(*limits) for operation, limits in discord_rate_limits.items()}
+        self.pending = {}  # slot -> coroutine function, in submission order
+        self.flush_task = None
+
+    def submit(self, slot, operation):
+        self.pending.pop(slot, None)
+        self.pending[slot] = operation
+        if self.flush_task is None or self.flush_task.done():
+            self.flush_task = asyncio.create_task(self.flush_after_window())
+
+    def discard(self, slot):
+        self.pending.pop(slot, None)
+
+    def clear_pending(self):
+        # Returns the slots whose queued work was dropped
+        slots = list(self.pending)
+        self.pending.clear()
+        return slots
+
+    async def flush_after_window(self):
+        await asyncio.sleep(self.debounce)
+        while self.pending:
+            slot = next(iter(self.pending))
+            operation = self.pending.pop(slot)
+            try:
+                await operation()
+            except Exception:
+                log.exception("Failed to post update", extra={'slot': slot})
+
+    async def call(self, operation, request):
+        bucket = self.buckets[operation]
+        for attempt in range(3):
+            await bucket.acquire()
+            try:
+                with metrics.timer('nowplaying_discord_request_seconds', operation=operation):
+                    result = await request()
+                metrics.inc('nowplaying_discord_requests_total', operation=operation, result='ok')
+                return result
+            except discord.HTTPException as e:
+                metrics.inc('nowplaying_discord_requests_total', operation=operation, result=str(e.status))
+                if e.status != 429 or attempt == 2:
+                    raise
+                retry_after = float(e.response.headers.get('Retry-After', 1)) if e.response is not None else 1
+                bucket.block(retry_after)
+
+    async def send(self, **fields):
+        message = await self.call('send', lambda: self.thread.send(**fields))
+        await self.registry.add(message.id)
+        return message
+
+    async def edit(self, message, **fields):
+        file = fields.pop('file', None)
+        if file is None:
+            await self.call('edit', lambda: message.edit(**fields))
+            return message
+        # A PartialMessage can't upload files itself, so use the HTTP route Message.edit uses for this
+        embed = fields.get('embed')
+        payload = {'embeds': [embed.to_dict()] if embed else [], 'attachments': fields.get('attachments', [])}
+        try:
+            await self.call('edit', lambda: message._state.http.edit_files(message.channel.id, message.id, files=[file], **payload))
+        finally:
+            file.close()
+        return message
+
+    async def delete(self, message):
+        try:
+            await self.call('delete', lambda: message.delete())
+        except discord.NotFound:
+            await self.registry.discard([message.id])
+            raise
+        await self.registry.discard([message.id])
+
+
+class ArtworkStore:
+    # Upload-once artwork. Each image is uploaded once to the artwork channel and remembered by its Discord CDN
+    # URL, keyed by the image's item ID and tag (or its digest when Emby gave it no tag), so posts in any thread
+    # embed the URL instead of uploading the same bytes again. Signed URLs expire, so a URL close to expiry is
+    # refreshed from the message it was uploaded in; the image is only uploaded again if that message is gone.
+    def __init__(self, channel_id, capacity, margin, ttl):
+        self.channel_id = channel_id
+        self.capacity = capacity
+        self.margin = margin
+        self.ttl = ttl
+        self.channel = None
+        self.outbox = None  # Only used for its rate-limit buckets; nothing in the artwork channel is ever deleted
+        self.entries = OrderedDict()  # key -> (url, expires_at, message_id, attachment index)
+        self.inflight = {}  # key -> future resolving to its URL (or None) while an upload or refresh runs
+
+    def start(self, channel):
+        self.channel = channel
+        self.outbox = DiscordOutbox(channel, None)
+
+    @staticmethod
+    def key(artwork_key, attachment):
+        return artwork_key or ('sha1', hashlib.sha1(attachment[1]).hexdigest())
+
+    def expiry(self, url):
+        # Signed attachment URLs carry their expiry as a hex Unix timestamp in the 'ex' parameter
+        ex = urllib.parse.parse_qs(urllib.parse.urlsplit(url).query).get('ex')
+        try:
+            return int(ex[0], 16) if ex else time.time() + self.ttl
+        except ValueError:
+            return time.time() + self.ttl
+
+    def remember(self, key, url, message_id, index):
+        self.entries[key] = (url, self.expiry(url), message_id, index)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.capacity:
+            self.entries.popitem(last=False)
+
+    def settle(self, key, url, result):
+        metrics.inc('nowplaying_artwork_store_total', result=result)
+        future = self.inflight.pop(key, None)
+        if future is not None and not future.done():
+            future.set_result(url)
+
+    async def link(self, view):
+        # The view's (embed, embed attachment, image embed, image attachment), with every attachment the store
+        # has a URL for swapped for an embed reference to that URL
+        embed, embed_attachment, image_attachment = view.embed, view.embed_attachment, view.image_attachment
+        if self.channel is None:
+            return embed, embed_attachment, None, image_attachment
+
+        attachments = (embed_attachment, image_attachment)
+        keys = [self.key(artwork_key, attachment) if attachment else None for artwork_key, attachment in zip(view.keys, attachments)]
+        urls = await self.urls([(key, attachment) for key, attachment in zip(keys, attachments) if key])
+
+        image_embed = None
+        if urls.get(keys[0]):
+            embed = linked_embed(embed, embed_attachment[0], urls[keys[0]])
+            embed_attachment = None
+        if urls.get(keys[1]):
+            image_embed = linked_embed(None, image_attachment[0], urls[keys[1]])
+            image_attachment = None
+        return embed, embed_attachment, image_embed, image_attachment
+
+    async def urls(self, items):
+        # CDN URL per key (None where it couldn't be had). Whatever has to be uploaded goes up in one message;
+        # a key already being uploaded or refreshed for someone else is waited on rather than sent twice.
+        loop = asyncio.get_running_loop()
+        waiting = {}
+        refresh = []
+        upload = []
+        for key, attachment in items:
+            if key in waiting:
+                continue
+            if key in self.inflight:
+                waiting[key] = self.inflight[key]
+                continue
+            entry = self.entries.get(key)
+            if entry and entry[1] - self.margin > time.time():
+                self.entries.move_to_end(key)
+                metrics.inc('nowplaying_artwork_store_total', result='reused')
+                waiting[key] = loop.create_future()
+                waiting[key].set_result(entry[0])
+                continue
+            waiting[key] = self.inflight[key] = loop.create_future()
+            (refresh if entry else upload).append((key, attachment))
+
+        taken = [key for key, _ in refresh + upload]
+        try:
+            if refresh:
+                upload.extend(await self.refresh(refresh))
+            if upload:
+                await self.upload(upload)
+        finally:
+            # Never leave someone else waiting on a key this call took on
+            for key in taken:
+                if not waiting[key].done():
+                    self.settle(key, None, 'failed')
+        return {key: await future for key, future in waiting.items()}
+
+    async def refresh(self, items):
+        # Re-read the messages the URLs came from for freshly signed ones; returns the items whose message is gone
+        gone = []
+        by_message = defaultdict(list)
+        for key, attachment in items:
+            by_message[self.entries[key][2]].append((key, attachment))
+        for message_id, message_items in by_message.items():
+            try:
+                message = await self.outbox.call('fetch', lambda: self.channel.fetch_message(message_id))
+            except discord.NotFound:
+                gone.extend(message_items)
+                continue
+            except discord.HTTPException as e:
+                log.warning("Could not refresh artwork URLs", extra={'message_id': message_id, 'error': str(e)})
+                for key, _ in message_items:
+                    self.settle(key, None, 'failed')
+                continue
+            for key, attachment in message_items:
+                index = self.entries[key][3]
+                if index < len(message.attachments):
+                    url = message.attachments[index].url
+                    self.remember(key, url, message_id, index)
+                    self.settle(key, url, 'refreshed')
+                else:
+                    gone.append((key, attachment))
+        for key, _ in gone:
+            self.entries.pop(key, None)
+        return gone
+
+    async def upload(self, items):
+        files = [discord.File(BytesIO(attachment[1]), filename=attachment[0]) for _, attachment in items]
+        try:
+            message = await self.outbox.call('send', lambda: self.channel.send(files=files))
+        except discord.HTTPException as e:
+            log.warning("Could not upload artwork", extra={'error': str(e)})
+            for key, _ in items:
+                self.settle(key, None, 'failed')
+            return
+        finally:
+            for file in files:
+                file.close()
+        for index, (key, _) in enumerate(items):
+            url = message.attachments[index].url if index < len(message.attachments) else None
+            if url:
+                self.remember(key, url, message.id, index)
+            self.settle(key, url, 'uploaded' if url else 'failed')
+
+
+def linked_embed(embed, filename, url):
+    # Point an embed's attachment://filename references at the URL; a standalone image becomes an image-only embed
+    if embed is None:
+        return discord.Embed(color=discord.Color.blue()).set_image(url=url)
+    data = embed.to_dict()
+    for field in ('thumbnail', 'image'):
+        if data.get(field, {}).get('url') == f"attachment://{filename}":
+            data[field] = {'url': url}
+    return discord.Embed.from_dict(data)
+
+
+artwork_store = ArtworkStore(artwork_store_channel_id, artwork_store_capacity, artwork_url_margin, artwork_url_ttl)
+
+
+class PresenceManager:
+    # Owns the bot's presence. Each playing user claims a status text; the highest-priority claim wins and
+    # is sent to the gateway only when the winning text changes. Sends are paced by a token bucket, and a
+    # change that arrives while waiting replaces the one queued, so only the latest winner goes out.
+    def __init__(self, user_priority, media_priority, rate_limit):
+        self.user_priority = user_priority
+        self.media_priority = media_priority
+        self.bucket = RateLimitBucket(*rate_limit)
+        self.claims = {}  # (server name, username) -> (text, media_type, claimed_at)
+        self.current = None  # Text last sent to Discord
+        self.task = None
+
+    def rank(self, username, media_type, claimed_at):
+        user_rank = self.user_priority.index(username) if username in self.user_priority else len(self.user_priority)
+        media_rank = self.media_priority.index(media_type) if media_type in self.media_priority else len(self.media_priority)
+        return (user_rank, media_rank, claimed_at)
+
+    def winner(self):
+        if not self.claims:
+            return "Nothing"
+        key = min(self.claims, key=lambda key: self.rank(key[1], self.claims[key][1], self.claims[key][2]))
+        return self.claims[key][0]
+
+    def claim(self, bot, server_name, username, text, media_type=None):
+        key = (server_name, username)
+        previous = self.claims.get(key)
+        if previous and previous[0] == text[:128]:
+            return
+        # A user keeps their original claim time across track changes, so the status doesn't flip between
+        # equally ranked users every time one of them skips
+        self.claims[key] = (text[:128], media_type, previous[2] if previous else time.monotonic())
+        self.schedule(bot)
+
+    def release(self, bot, server_name, username):
+        if self.claims.pop((server_name, username), None) is not None:
+            self.schedule(bot)
+
+    def retain(self, bot, server_name, usernames):
+        # Drop the claims of a server's users who are no longer playing
+        for key in [key for key in self.claims if key[0] == server_name and key[1] not in usernames]:
+            self.release(bot, *key)
+
+    def clear(self, bot, server_name):
+        self.retain(bot, server_name, ())
+
+    def schedule(self, bot):
+        if self.winner() != self.current and (self.task is None or self.task.done()):
+            self.task = asyncio.create_task(self.flush(bot))
+
+    async def flush(self, bot):
+        while self.winner() != self.current:
+            await self.bucket.acquire()
+            text = self.winner()  # Re-read after waiting: whatever changed in the meantime is folded in
+            if text == self.current:
+                break
+            try:
+                await bot.change_presence(activity=discord.Game(name=text))
+            except Exception as e:
+                log.warning("Failed to update bot status", extra={'status': text, 'error': repr(e)})
+                return
+            self.current = text
+            log.info("Updated bot status", extra={'status': text})
+
+
+presence_manager = PresenceManager(presence_user_priority, presence_media_priority, presence_rate_limit)
+
+
+class PollCadence:
+    # One server's adaptive /Sessions poll interval: tight while someone is playing, doubling while idle up
+    # to the maximum, and pulled forward so a poll lands right after the earliest playing item is due to
+    # end (from PlayState.PositionTicks and RunTimeTicks). 'interval' is the interval in effect.
+    def __init__(self, min_interval, active_interval, max_interval, backoff, end_margin):
+        self.min_interval = min_interval
+        self.active_interval = active_interval
+        self.max_interval = max_interval
+        self.backoff = backoff
+        self.end_margin = end_margin
+        self.interval = active_interval
+        self.next_end = None  # Loop time just after the earliest predicted end
+        self.due = 0  # Loop time of the next poll
+
+    def observe(self, playing_sessions):
+        # Called with the watched sessions that have a NowPlayingItem, after every poll or pushed update
+        if playing_sessions:
+            interval = self.active_interval
+        else:
+            interval = min(self.max_interval, max(self.interval, self.active_interval) * self.backoff)
+        if interval != self.interval:
+            log.debug("Poll interval changed", extra={'interval': round(interval)})
+        self.interval = interval
+
+        self.next_end = None
+        now = asyncio.get_running_loop().time()
+        for session in playing_sessions:
+            play_state = session.get('PlayState') or {}
+            runtime = session['NowPlayingItem'].get('RunTimeTicks')
+            position = play_state.get('PositionTicks')
+            if play_state.get('IsPaused') or not runtime or position is None:
+                continue
+            # Ticks are 100 ns units
+            end = now + max(0, (runtime - position) / 10_000_000) + self.end_margin
+            if self.next_end is None or end < self.next_end:
+                self.next_end = end
+
+    def next_delay(self):
+        delay = self.interval
+        if self.next_end is not None:
+            delay = min(delay, self.next_end - asyncio.get_running_loop().time())
+        return max(self.min_interval, delay)
+
+
+class PollScheduler:
+    # One loop that polls every server on its own cadence. Each poll runs as its own task, so a slow or
+    # unreachable server only pushes back its own next poll; a server still busy with its last poll is
+    # skipped until that finishes.
+    def __init__(self):
+        self.servers = []
+        self.running = {}  # server name -> poll task in flight
+        self.wakeup = asyncio.Event()
+        self.task = None
+
+    def poll_soon(self, server):
+        server.cadence.due = 0
+        self.wakeup.set()
+
+    async def poll_server(self, server, poll):
+        try:
+            await poll(server)
+        finally:
+            server.cadence.due = asyncio.get_running_loop().time() + server.cadence.next_delay()
+            self.wakeup.set()
+
+    async def run(self, poll):
+        loop = asyncio.get_running_loop()
+        while True:
+            self.wakeup.clear()
+            now = loop.time()
+            waiting = []
+            for server in self.servers:
+                task = self.running.get(server.name)
+                if task is not None and not task.done():
+                    continue  # Its next due time is set when it finishes
+                if server.cadence.due <= now:
+                    self.running[server.name] = asyncio.create_task(self.poll_server(server, poll))
+                else:
+                    waiting.append(server.cadence.due - now)
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=min(waiting, default=poll_interval_max))
+            except asyncio.TimeoutError:
+                pass
+
+    def start(self, servers, poll):
+        self.servers = list(servers)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run(poll))
+
+
+poll_scheduler = PollScheduler()
+
+
+class ArtistIndex:
+    # In-memory copy of Emby's artist list for /q_artist. Names are kept sorted for prefix search with
+    # bisect, with a trigram index on the side for fuzzy matches, so a lookup never leaves the process.
+    def __init__(self, page_size):
+        self.page_size = page_size
+        self.artists = {}  # artist id -> {'id', 'name', 'key', 'trigram_count', 'image_tag'}
+        self.sorted_keys = []  # (search key, artist id), sorted
+        self.trigram_index = defaultdict(set)  # trigram -> artist ids
+        self.last_sync = None  # UTC time the last sync started
+        self.last_full_sync = None
+
+    @staticmethod
+    def search_key(name):
+        key = name.lower().strip()
+        return key[4:] if key.startswith('the ') else key
+
+    @staticmethod
+    def trigrams(text):
+        padded = f"  {text} "
+        return {padded[i:i + 3] for i in range(len(padded) - 2)}
+
+    def add(self, artist):
+        artist_id = artist.get('Id')
+        name = artist.get('Name')
+        if not artist_id or not name:
+            return
+        self.remove(artist_id)
+        key = self.search_key(name)
+        trigrams = self.trigrams(key)
+        self.artists[artist_id] = {
+            'id': artist_id,
+            'name': name,
+            'key': key,
+            'trigram_count': len(trigrams),
+            'image_tag': (artist.get('ImageTags') or {}).get('Primary'),
+        }
+        bisect.insort(self.sorted_keys, (key, artist_id))
+        for trigram in trigrams:
+            self.trigram_index[trigram].add(artist_id)
+
+    def remove(self, artist_id):
+        old = self.artists.pop(artist_id, None)
+        if old is None:
+            return
+        position = bisect.bisect_left(self.sorted_keys, (old['key'], artist_id))
+        if position < len(self.sorted_keys) and self.sorted_keys[position] == (old['key'], artist_id):
+            del self.sorted_keys[position]
+        for trigram in self.trigrams(old['key']):
+            self.trigram_index[trigram].discard(artist_id)
+
+    def search(self, query, limit=25):
+        # Prefix matches first, then fuzzy matches to fill the list; returns artist records
+        key = self.search_key(query)
+        if not key:
+            return [self.artists[artist_id] for _, artist_id in self.sorted_keys[:limit]]
+
+        matches = []
+        position = bisect.bisect_left(self.sorted_keys, (key, ''))
+        while position < len(self.sorted_keys) and len(matches) < limit:
+            candidate_key, artist_id = self.sorted_keys[position]
+            if not candidate_key.startswith(key):
+                break
+            matches.append(artist_id)
+            position += 1
+
+        # Fuzzy matching only makes sense once there are a few characters to compare
+        if len(matches) < limit and len(key) >= 4:
+            query_trigrams = self.trigrams(key)
+            counts = Counter()
+            for trigram in query_trigrams:
+                counts.update(self.trigram_index.get(trigram, ()))
+            # Jaccard similarity needs at least this many shared trigrams to reach the 0.3 cut-off
+            minimum_shared = 0.3 * len(query_trigrams)
+            scored = []
+            for artist_id, shared in counts.items():
+                if shared < minimum_shared or artist_id in matches:
+                    continue
+                score = shared / (len(query_trigrams) + self.artists[artist_id]['trigram_count'] - shared)
+                if score >= 0.3:
+                    scored.append((-score, self.artists[artist_id]['key'], artist_id))
+            matches.extend(artist_id for _, _, artist_id in sorted(scored)[:limit - len(matches)])
+
+        return [self.artists[artist_id] for artist_id in matches]
+
+    def best_match(self, query):
+        results = self.search(query, limit=1)
+        return results[0] if results else None
+
+    async def sync(self, emby):
+        # Incremental: only artists saved since the last sync. A periodic full sync also drops deleted ones.
+        started = datetime.utcnow()
+        full = self.last_full_sync is None or (started - self.last_full_sync).total_seconds() >= artist_index_full_sync_interval
+        params = {'Limit': self.page_size, 'Fields': 'DateLastSaved'}
+        if not full:
+            params['MinDateLastSaved'] = (self.last_sync - timedelta(minutes=1)).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+        seen = set()
+        start_index = 0
+        while True:
+            params['StartIndex'] = start_index
+            status, data = await emby.get_json('/emby/Artists', params=params)
+            if status != 200:
+                log.warning("Artist index sync failed", extra={'status': status})
+                return
+            items = data.get('Items', [])
+            for artist in items:
+                self.add(artist)
+                seen.add(artist.get('Id'))
+            start_index += len(items)
+            if not items or start_index >= data.get('TotalRecordCount', 0):
+                break
+
+        if full:
+            for artist_id in [artist_id for artist_id in self.artists if artist_id not in seen]:
+                self.remove(artist_id)
+            self.last_full_sync = started
+        self.last_sync = started
+        log.info(f"Artist index {'rebuilt' if full else 'updated'}", extra={'fetched': len(seen), 'artists': len(self.artists)})
+
+
+artist_index = ArtistIndex(artist_index_page_size)
+
+
+class PlayHistory:
+    # Append-only log of every item a watched user starts, one compact JSON object per line:
+    #   {"t": unix time, "s": server, "u": user, "i": item id, "m": media type, "n": title}
+    # Records are queued and written in batches by a background task with one fsync per batch, so a burst of
+    # track changes costs one disk flush. On top of the log sits an in-memory index that /history and /top answer
+    # from without touching Emby or the disk: each user's most recent plays (bounded in count) for /history, and
+    # per-day play counts per user and overall (bounded in age) for /top.
+    def __init__(self, path, flush_interval, flush_batch, per_user, max_age_days, max_bytes):
+        self.path = path
+        self.flush_interval = flush_interval
+        self.flush_batch = flush_batch
+        self.per_user = per_user
+        self.max_age = max_age_days * 86400
+        self.max_bytes = max_bytes
+        self.index = {}  # (server name, username) -> deque of records, oldest first
+        self.daily = {}  # (server name, username) -> {day number: Counter of (server name, item id, title)}
+        self.daily_all = {}  # day number -> Counter of (server name, item id, title) over every user
+        self.pending = []  # Records not written yet
+        self.wakeup = asyncio.Event()
+        self.task = None
+        self.loaded = False
+
+    async def load(self):
+        # The previous log generation first, so the index ends up in time order
+        for path in (self.path + '.1', self.path):
+            for record in await asyncio.to_thread(self.read_log, path):
+                self.add(record)
+        self.loaded = True
+
+    def read_log(self, path):
+        cutoff = time.time() - self.max_age
+        records = []
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue  # A line cut short by a crash mid-write
+                    if record.get('t', 0) >= cutoff:
+                        records.append(record)
+        except FileNotFoundError:
+            pass
+        return records
+
+    def add(self, record):
+        key = (record['s'], record['u'])
+        plays = self.index.get(key)
+        if plays is None:
+            plays = self.index[key] = deque(maxlen=self.per_user)
+        plays.append(record)
+
+        day = record['t'] // 86400
+        item = (record['s'], record['i'], record['n'])
+        self.daily.setdefault(key, {}).setdefault(day, Counter())[item] += 1
+        self.daily_all.setdefault(day, Counter())[item] += 1
+
+        # Drop whatever has aged out of the index
+        cutoff = record['t'] - self.max_age
+        while plays[0]['t'] < cutoff:
+            plays.popleft()
+        first_day = cutoff // 86400
+        for days in (self.daily[key], self.daily_all):
+            for old_day in [old_day for old_day in days if old_day < first_day]:
+                del days[old_day]
+
+    def record(self, server_name, username, item_id, media_type, title):
+        record = {'t': int(time.time()), 's': server_name, 'u': username, 'i': item_id, 'm': media_type, 'n': title}
+        self.add(record)
+        self.pending.append(record)
+        if len(self.pending) >= self.flush_batch:
+            self.wakeup.set()
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush_loop())
+
+    async def flush_loop(self):
+        while self.pending:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self.wakeup.clear()
+            await self.flush()
+
+    async def flush(self):
+        batch, self.pending = self.pending, []
+        if not batch:
+            return
+        data = ''.join(json.dumps(record, separators=(',', ':')) + '\n' for record in batch)
+        try:
+            await asyncio.to_thread(self.write, data)
+        except OSError as e:
+            log.error("Failed to write play history", extra={'path': self.path, 'records': len(batch), 'error': str(e)})
+
+    def write(self, data):
+        # Past max_bytes the log moves aside to <log>.1 (replacing the one before) and a new one is started
+        try:
+            if os.path.getsize(self.path) > self.max_bytes:
+                os.replace(self.path, self.path + '.1')
+        except FileNotFoundError:
+            pass
+        with open(self.path, 'a', encoding='utf-8') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def users(self):
+        return sorted({username for _, username in self.index})
+
+    def recent(self, username, limit):
+        # The user's latest plays across every server, newest first
+        plays = [record for (_, user), records in self.index.items() if user == username for record in records]
+        plays.sort(key=lambda record: record['t'])
+        return plays[::-1][:limit]
+
+    def top(self, days, username=None, limit=10):
+        # (title, play count) of the most played items over the last `days` UTC days (today included), for one
+        # user or everyone; only sums that many per-day counters per user, however many plays they hold
+        first_day = int(time.time()) // 86400 - days + 1
+        if username is None:
+            by_day = [self.daily_all]
+        else:
+            by_day = [days_counts for (_, user), days_counts in self.daily.items() if user == username]
+        counts = Counter()
+        for days_counts in by_day:
+            for day, day_counts in days_counts.items():
+                if day >= first_day:
+                    counts.update(day_counts)
+        return [(title, plays) for (_, _, title), plays in counts.most_common(limit)]
+
+
+play_history = PlayHistory(history_log_path, history_flush_interval, history_flush_batch, history_index_per_user,
+                           history_index_days, history_max_bytes)
+
+
+class StateStore:
+    # Per-user now-playing state (last item, posted message IDs, content fingerprints, update time) in a
+    # small SQLite database. All queries run in a worker thread so disk I/O never blocks the event loop.
+    def __init__(self, path):
+        self.path = path
+        self.connection = None
+        self.lock = threading.Lock()
+
+    def connect(self):
+        if self.connection is None:
+            self.connection = sqlite3.connect(self.path, check_same_thread=False)
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS user_state (
+                    username TEXT PRIMARY KEY,
+                    last_item_id TEXT,
+                    embed_message_id INTEGER,
+                    image_message_id INTEGER,
+                    embed_fingerprint TEXT,
+                    image_fingerprint TEXT,
+                    updated_at REAL
+                );
+                CREATE TABLE IF NOT EXISTS bot_state (
+                    key TEXT PRIMARY KEY,
+                    value TEXT
+                );
+                CREATE TABLE IF NOT EXISTS owned_messages (
+                    message_id INTEGER PRIMARY KEY
+                );
+            ''')
+        return self.connection
+
+    def read_all(self):
+        with self.lock:
+            connection = self.connect()
+            connection.row_factory = sqlite3.Row
+            users = {row['username']: dict(row) for row in connection.execute('SELECT * FROM user_state')}
+            values = dict(connection.execute('SELECT key, value FROM bot_state').fetchall())
+            connection.row_factory = None
+            return users, values
+
+    def write_user(self, username, last_item_id, embed_message_id, image_message_id, embed_fingerprint, image_fingerprint):
+        with self.lock:
+            connection = self.connect()
+            connection.execute(
+                'INSERT OR REPLACE INTO user_state VALUES (?, ?, ?, ?, ?, ?, ?)',
+                (username, last_item_id, embed_message_id, image_message_id, embed_fingerprint, image_fingerprint, time.time()),
+            )
+            connection.commit()
+
+    def write_value(self, key, value):
+        with self.lock:
+            connection = self.connect()
+            if value is None:
+                connection.execute('DELETE FROM bot_state WHERE key = ?', (key,))
+            else:
+                connection.execute('INSERT OR REPLACE INTO bot_state VALUES (?, ?)', (key, str(value)))
+            connection.commit()
+
+    def read_owned(self):
+        with self.lock:
+            connection = self.connect()
+            return {row[0] for row in connection.execute('SELECT message_id FROM owned_messages')}
+
+    def write_owned(self, message_ids, owned):
+        with self.lock:
+            connection = self.connect()
+            if owned:
+                connection.executemany('INSERT OR IGNORE INTO owned_messages VALUES (?)', [(i,) for i in message_ids])
+            else:
+                connection.executemany('DELETE FROM owned_messages WHERE message_id = ?', [(i,) for i in message_ids])
+            connection.commit()
+
+    async def load(self):
+        return await asyncio.to_thread(self.read_all)
+
+    async def save_user(self, username, state, item_id):
+        # state is the user's UserState, or None to clear their row
+        embed_message = state.embed_message if state else None
+        image_message = state.image_message if state else None
+        try:
+            await asyncio.to_thread(
+                self.write_user, username, item_id,
+                embed_message.id if embed_message else None,
+                image_message.id if image_message else None,
+                state.embed_fingerprint if state else None,
+                state.image_fingerprint if state else None,
+            )
+        except sqlite3.Error as e:
+            log.error("Failed to save state", extra={'user': username, 'error': str(e)})
+
+    async def save_value(self, key, value):
+        try:
+            await asyncio.to_thread(self.write_value, key, value)
+        except sqlite3.Error as e:
+            log.error("Failed to save state value", extra={'key': key, 'error': str(e)})
+
+
+
+class MessageRegistry:
+    # IDs of every message the bot has posted in the thread and not deleted yet, kept in the state store.
+    # Cleanup works from this list, so it never has to scan channel history to find the bot's messages.
+    def __init__(self, store):
+        self.store = store
+        self.ids = set()
+
+    async def load(self):
+        self.ids = await asyncio.to_thread(self.store.read_owned)
+
+    async def add(self, message_id):
+        self.ids.add(message_id)
+        await self.persist([message_id], True)
+
+    async def discard(self, message_ids):
+        message_ids = [message_id for message_id in message_ids if message_id in self.ids]
+        self.ids.difference_update(message_ids)
+        if message_ids:
+            await self.persist(message_ids, False)
+
+    async def persist(self, message_ids, owned):
+        try:
+            await asyncio.to_thread(self.store.write_owned, message_ids, owned)
+        except sqlite3.Error as e:
+            log.error("Failed to update message registry", extra={'error': str(e)})
+
 
 
 # Initialize Discord bot with intents
@@ -38,444 +1761,1223 @@ intents.typing = False                  # Typically not needed, can be spammy
 bot = commands.Bot(command_prefix='/', intents=intents)
 
 # User-specific configurations
-users_watch = ['tim','jeffery']  # List of usernames to watch (case-insensitive)
-users_ignore = ['adult']  # List of usernames to ignore (case-insensitive)
-
-# Dictionary to keep track of the last item and last message for each user
-last_user_info = {
-    user.lower(): {
-        'last_item_id': None, 
-        'last_embed_message': None,  # This will track the message with the embed
-        'last_image_message': None  # This will track the separate image message
-    } for user in users_watch
+users_watch = ['tim','jeffery']  # Usernames to watch (case-insensitive); wildcards like 'guest*' and Emby user IDs work too
+users_ignore = ['adult']  # Usernames to ignore, same rules as users_watch
+
+
+class UserMatcher:
+    # Matches sessions against a watch or ignore list. Plain names and Emby user IDs go in a set; entries
+    # with wildcards are compiled into one regular expression. Results are memoized per (name, user ID),
+    # so after the first poll each session costs a single dict lookup.
+    def __init__(self, patterns):
+        self.exact = set()
+        wildcards = []
+        for pattern in patterns:
+            pattern = pattern.lower()
+            if any(char in pattern for char in '*?['):
+                wildcards.append(fnmatch.translate(pattern))
+            else:
+                self.exact.add(pattern)
+        self.pattern = re.compile('|'.join(wildcards)) if wildcards else None
+        self.results = {}
+
+    def matches(self, username, user_id=None):
+        key = (username, user_id)
+        result = self.results.get(key)
+        if result is None:
+            result = (username in self.exact or (user_id is not None and user_id.lower() in self.exact)
+                      or (self.pattern is not None and self.pattern.match(username) is not None))
+            if len(self.results) < 10000:
+                self.results[key] = result
+        return result
+
+
+class UserState:
+    # Per-user record in EmbyServer.users. Posted messages are kept as PartialMessage references (just the ID
+    # and the thread), not full Message objects. 'state' follows user_transitions:
+    #   idle    - nothing posted for the user, or their posts were cleared
+    #   playing - item_id is posted (or queued to be)
+    #   nothing - the user's slot shows the 'Nothing Playing' image
+    __slots__ = ('username', 'state', 'item_id', 'embed_message', 'image_message', 'embed_fingerprint',
+                 'image_fingerprint', 'updated_at', 'dashboard_field', 'embed', 'stale', 'restored_item_id')
+
+    def __init__(self, username):
+        self.username = username
+        self.state = 'idle'
+        self.item_id = None
+        self.embed_message = None
+        self.image_message = None
+        self.embed_fingerprint = None
+        self.image_fingerprint = None
+        self.updated_at = None
+        self.dashboard_field = None
+        self.embed = None  # Embed last posted in embed_message, kept so it can be marked stale and restored
+        self.stale = False  # embed_message currently carries the 'Emby unreachable' footer
+        self.restored_item_id = None  # Item the posts showed before a restart, until the user is rendered again
+
+    def transition(self, state, item_id=None):
+        if state == self.state and state != 'playing':
+            return
+        if state not in user_transitions[self.state]:
+            raise ValueError(f"User {self.username} can't go from {self.state} to {state}")
+        log.debug("User state change", extra={'user': self.username, 'from': self.state, 'to': state, 'item_id': item_id})
+        self.state = state
+        self.item_id = item_id if state == 'playing' else None
+        if state != 'playing':
+            self.dashboard_field = None
+
+    def play(self, item_id):
+        self.transition('playing', item_id)
+
+    def stop(self):
+        self.transition('idle')
+
+    def show_nothing(self):
+        self.transition('nothing')
+
+    def forget_messages(self):
+        # The posts are gone (cleared in bulk), so there is nothing left to edit
+        self.embed_message = self.image_message = None
+        self.embed_fingerprint = self.image_fingerprint = None
+        self.embed = None
+        self.stale = False
+        self.stop()
+
+
+user_transitions = {
+    'idle': ('playing', 'nothing'),
+    'playing': ('playing', 'idle', 'nothing'),
+    'nothing': ('playing', 'idle'),
 }
-last_global_nothing_message = None
+
+
+class EmbyServer:
+    # Everything tied to one monitored Emby server: its client, poll cadence, watch/ignore lists, target
+    # thread and outbox, state store, and the per-user state of the posts in that thread. Servers only
+    # share the bot, the artwork cache (keys are namespaced per server) and the bot's presence.
+    def __init__(self, name, emby, thread_channel_id, watch, ignore, cadence, store, ingest):
+        self.name = name
+        self.emby = emby
+        self.thread_channel_id = thread_channel_id
+        self.watch_matcher = UserMatcher(watch)
+        self.ignore_matcher = UserMatcher(ignore)
+        self.cadence = cadence
+        self.state_store = store
+        self.message_registry = MessageRegistry(store)
+        self.ingest_mode = ingest
+        self.thread = None
+        self.outbox = None
+        self.users = {}  # username -> UserState
+        self.nothing_message = None  # This server's 'Nothing Playing' post
+        self.dashboard = Dashboard(dashboard_interval)
+        # Serializes session processing so a pushed update and a poll never run the handlers at the same time
+        self.sessions_lock = asyncio.Lock()
+        self.user_locks = defaultdict(asyncio.Lock)  # One lock per user so their updates are applied in order
+        self.prefetched_views = {}  # username -> (item_id, NowPlayingView) for the track expected to play next
+        self.prefetch_tasks = {}  # username -> running prefetch task
+        self.websocket_connected = False
+        self.websocket_task = None
+        self.stale_since = None  # UTC time Emby became unreachable, while the posts show the last known state
+        self.sessions_fingerprint = None  # (username, item ID, paused) per watched playing session, as last dispatched
+
+    def is_watched(self, username, user_id=None):
+        return self.watch_matcher.matches(username, user_id) and not self.ignore_matcher.matches(username, user_id)
+
+    def user_state(self, username):
+        state = self.users.get(username)
+        if state is None:
+            state = self.users[username] = UserState(username)
+        return state
+
+    def partial_message(self, message):
+        # Keep only what is needed to edit or delete a posted message later
+        return self.thread.get_partial_message(message.id) if message is not None else None
+
+    async def fetch_sessions(self):
+        # Idle devices are filtered out by Emby, so the payload stays small however many clients are registered
+        params = {'ActiveWithinSeconds': sessions_active_within} if sessions_active_within else None
+        return await self.emby.get_json('/Sessions', params)
+
+    def settled(self, fingerprint):
+        # True once everything the last dispatch of this fingerprint queued has been applied, so a poll with
+        # the same fingerprint would do nothing. Anything that reset a user since (a handler that failed, a
+        # bulk clear) shows up here and sends the next poll down the full path again.
+        if not fingerprint:
+            if render_mode == 'dashboard':
+                return all(state.state != 'playing' for state in self.users.values())
+            return self.nothing_message is not None
+        if self.nothing_message is not None and render_mode != 'dashboard':
+            return False
+        for username, item_id, _ in fingerprint:
+            state = self.users.get(username)
+            if state is None or state.item_id != item_id:
+                return False
+            if render_mode != 'dashboard' and state.embed_message is None:
+                return False  # Its post is still queued, or never went out
+        return True
+
+
+def load_servers():
+    if not servers_config_path:
+        servers_config = [{'name': 'default'}]
+    else:
+        with open(servers_config_path, 'r', encoding='utf-8') as f:
+            servers_config = json.load(f)
+
+    servers = []
+    for config in servers_config:
+        name = config.get('name', 'default')
+        # The name keys each server's state file, artwork cache entries and poll slot, so it has to be unique
+        if servers_config_path and not config.get('name'):
+            raise ValueError(f"Every server in {servers_config_path} needs a name")
+        if any(server.name == name for server in servers):
+            raise ValueError(f"Emby server name '{name}' is used more than once in {servers_config_path}")
+        key = os.getenv(config['api_key_env']) if 'api_key_env' in config else config.get('api_key', api_key)
+        emby = EmbyClient(config.get('host', emby_server_ip), config.get('port', emby_server_port), key, name=name)
+        cadence = PollCadence(config.get('poll_min', poll_interval_min), config.get('poll_active', poll_interval_active),
+                              config.get('poll_max', poll_interval_max), poll_idle_backoff, poll_end_margin)
+        # The default server keeps the original state file, so an existing single-server setup carries on as before
+        root, extension = os.path.splitext(state_db_path)
+        store = StateStore(config.get('state_db', state_db_path if name == 'default' else f'{root}-{name}{extension}'))
+        thread_channel_id = int(config.get('thread_channel_id', emby_thread_channel_id))
+        if not thread_channel_id:
+            raise ValueError(f"Emby server '{name}' has no thread_channel_id and EMBY_THREAD_CHANNEL is not set")
+        servers.append(EmbyServer(name, emby, thread_channel_id,
+                                  config.get('watch', users_watch), config.get('ignore', users_ignore),
+                                  cadence, store, config.get('ingest_mode', ingest_mode).lower()))
+    return servers
+
+
+artist_index_task = None
+metrics_runner = None
+poll_count = 0
+poll_profiling = False  # Only one profiler can be active at a time, and polls of different servers overlap
 
 @bot.event
 async def on_ready():
-    global last_item_id
-    print(f'{bot.user.name} has connected to Discord!')
-    channel = bot.get_channel(emby_thread_channel_id)  # Use the channel ID from environment variable
+    global artist_index_task
+    log.info("Connected to Discord", extra={'bot_user': bot.user.name})
+
+    if not play_history.loaded:
+        await play_history.load()
+
+    if artwork_store_channel_id and artwork_store.channel is None:
+        channel = bot.get_channel(artwork_store_channel_id)
+        if channel is None:
+            log.error("Artwork channel not found, attaching artwork to every post", extra={'channel_id': artwork_store_channel_id})
+        else:
+            artwork_store.start(channel)
+
+    # Servers are set up side by side, so one that is slow to answer doesn't hold up the others, and one that
+    # fails to start is left out of polling until the next reconnect retries it
+    await asyncio.gather(*(start_server(server) for server in servers if server.thread is None))
+    poll_scheduler.start([server for server in servers if server.thread is not None], now_playing_check)
+
+    if artist_index_task is None:
+        artist_index_task = bot.loop.create_task(sync_artist_index())
+    await start_metrics_server()
+
+
+async def start_server(server):
+    try:
+        await set_up_server(server)
+    except Exception:
+        server.thread = None
+        log.exception("Failed to start server", extra={'server': server.name})
+
+
+async def set_up_server(server):
+    channel = bot.get_channel(server.thread_channel_id)  # Use the channel ID from the server's config
+    if channel is None:
+        log.error("Thread channel not found", extra={'server': server.name, 'channel_id': server.thread_channel_id})
+        return
     thread = discord.utils.get(channel.threads, name="Now Playing Updates")
     if thread is None:
         thread = await channel.create_thread(name="Now Playing Updates", type=discord.ChannelType.private_thread)
-        print("Created new thread for updates.")
+        log.info("Created new thread for updates", extra={'server': server.name, 'thread_id': thread.id})
     else:
-        print("Found existing thread.")
+        log.info("Found existing thread", extra={'server': server.name, 'thread_id': thread.id})
 
-    # Initialize bot.last_now_playing_message
-    bot.last_now_playing_message = None
+    server.outbox = DiscordOutbox(thread, server.message_registry)
+    server.thread = thread
 
-    messages = await thread.history(limit=200).flatten()
-    for message in messages:
-        if message.author == bot.user:
-            await message.delete()
-            bot.last_now_playing_message = message  # Update the last bot message
+    # Pick up the messages posted before the restart instead of wiping the thread
+    await restore_posted_state(server)
+    if render_mode == 'dashboard':
+        server.dashboard.schedule(server)  # Show the current state (even if empty) without waiting for a change
 
-    bot.now_playing_thread = thread
-    now_playing_check.start()
+    if server.ingest_mode == 'websocket' and server.websocket_task is None:
+        server.websocket_task = asyncio.create_task(emby_websocket_listener(server))
 
 
+async def start_metrics_server():
+    global metrics_runner
 
-@bot.slash_command(name='q_artist', description='Query artist information from Emby server')
-async def query_artist(ctx, artist_name: Option(str, "Enter the artist's name")):
-    emby_server_ip = '192.168.4.101'  # Replace with your Emby server IP
-    emby_server_port = '8096'  # Replace with your Emby server port
-    api_key = os.getenv('EMBY_API_BOT_KEY')  # Replace with your API key
-
-    # Emby API endpoint to search for an artist
-    search_url = f"http://{emby_server_ip}:{emby_server_port}/emby/Artists?SearchTerm={artist_name}&api_key={api_key}"
-    response = requests.get(search_url)
-    if response.status_code == 200:
-        artist_data = response.json()
-        if artist_data['Items']:
-            # Assuming the artist data contains an image
-            artist_id = artist_data['Items'][0]['Id']
-            image_tag = artist_data['Items'][0]['ImageTags'].get('Primary', '')
-            if image_tag:
-                image_url = f"http://{emby_server_ip}:{emby_server_port}/emby/Items/{artist_id}/Images/Primary?tag={image_tag}&api_key={api_key}"
-                embed = discord.Embed(title=f"Artist Information: {artist_name}")
-                embed.set_thumbnail(url=image_url)
-                await ctx.respond(embed=embed)
-            else:
-                await ctx.respond(f"Artist found, but no image available for {artist_name}.")
-        else:
-            await ctx.respond(f"No artist found with the name {artist_name}.")
-    else:
-        await ctx.respond(f"Failed to retrieve data for artist '{artist_name}'.")
+    if metrics_runner is not None or not metrics_port:
+        return
+    app = web.Application()
+    app.router.add_get('/metrics', serve_metrics)
+    metrics_runner = web.AppRunner(app, access_log=None)
+    await metrics_runner.setup()
+    try:
+        await web.TCPSite(metrics_runner, metrics_host, metrics_port).start()
+        log.info("Serving metrics", extra={'address': f'http://{metrics_host}:{metrics_port}/metrics'})
+    except OSError as e:
+        log.error("Could not start metrics endpoint", extra={'port': metrics_port, 'error': str(e)})
 
 
-@tasks.loop(seconds=10)
-async def now_playing_check():
-    global last_user_info, last_global_nothing_message
+async def serve_metrics(request):
+    return web.Response(text=metrics.render(), content_type='text/plain', charset='utf-8',
+                        headers={'X-Content-Type-Options': 'nosniff'})
 
-    print("Checking now playing...")
 
-    try:
-        response = requests.get(f'http://{emby_server_ip}:{emby_server_port}/Sessions', headers={'X-Emby-Token': api_key})
-        if response.status_code != 200:
-            print(f"Failed to retrieve 'Now Playing' information from Emby. Status Code: {response.status_code}")
+metrics.gauge('nowplaying_artwork_inflight_bytes', 'Bytes reserved by image transfers from Emby in progress',
+              lambda: {(): artwork_budget.in_use})
+metrics.gauge('nowplaying_artwork_cache', 'Artwork cache hits, misses and size by kind',
+              lambda: {(('kind', key),): value for key, value in artwork_cache.stats().items()})
+metrics.gauge('nowplaying_poll_interval_seconds', 'Poll interval currently in effect',
+              lambda: {(('server', server.name),): server.cadence.interval for server in servers})
+metrics.gauge('nowplaying_emby_circuit_state', 'Emby circuit breaker state: 0 closed, 1 half-open, 2 open',
+              lambda: {(('server', server.name),): ('closed', 'half_open', 'open').index(server.emby.breaker.state) for server in servers})
+metrics.gauge('nowplaying_websocket_connected', 'Whether session updates are arriving over the Emby WebSocket',
+              lambda: {(('server', server.name),): int(server.websocket_connected) for server in servers})
+metrics.gauge('nowplaying_owned_messages', 'Messages the bot currently owns in the thread',
+              lambda: {(('server', server.name),): len(server.message_registry.ids) for server in servers})
+
+
+
+async def sync_artist_index():
+    # /q_artist answers from the first configured server
+    while True:
+        try:
+            await artist_index.sync(servers[0].emby)
+        except Exception:
+            log.exception("Artist index sync failed")
+        await asyncio.sleep(artist_index_sync_interval)
+
+
+async def artist_autocomplete(ctx: discord.AutocompleteContext):
+    # Answered from the local index, so typing never costs an Emby round-trip
+    return [artist['name'][:100] for artist in artist_index.search(ctx.value or '', limit=25)]
+
+
+@bot.slash_command(name='q_artist', description='Query artist information from Emby server')
+async def query_artist(ctx, artist_name: Option(str, "Enter the artist's name", autocomplete=artist_autocomplete)):
+    # Look the artist up in the local index first; only go to Emby if it hasn't been synced or has no match
+    artist = artist_index.best_match(artist_name)
+    if artist:
+        artist_id = artist['id']
+        image_tag = artist['image_tag']
+        artist_name = artist['name']
+    else:
+        # Emby API endpoint to search for an artist
+        try:
+            status, artist_data = await servers[0].emby.get_json('/emby/Artists', params={'SearchTerm': artist_name})
+        except (EmbyUnavailable, aiohttp.ClientError, asyncio.TimeoutError):
+            await ctx.respond("The Emby server can't be reached right now.")
+            return
+        if status != 200:
+            await ctx.respond(f"Failed to retrieve data for artist '{artist_name}'.")
+            return
+        if not artist_data['Items']:
+            await ctx.respond(f"No artist found with the name {artist_name}.")
             return
+        # Prefer an exact name match over whatever Emby happened to list first
+        items = artist_data['Items']
+        match = next((entry for entry in items if entry['Name'].lower() == artist_name.lower()), items[0])
+        artist_id = match['Id']
+        image_tag = match.get('ImageTags', {}).get('Primary', '')
+
+    if image_tag:
+        image_url = servers[0].emby.url(f"/emby/Items/{artist_id}/Images/Primary", tag=image_tag)
+        embed = discord.Embed(title=f"Artist Information: {artist_name}")
+        embed.set_thumbnail(url=image_url)
+        await ctx.respond(embed=embed)
+    else:
+        await ctx.respond(f"Artist found, but no image available for {artist_name}.")
+
+
+async def history_user_autocomplete(ctx: discord.AutocompleteContext):
+    # Users with recorded plays, from the in-memory history index
+    prefix = (ctx.value or '').lower()
+    return [username for username in play_history.users() if username.startswith(prefix)][:25]
+
+
+@bot.slash_command(name='history', description='Show what a user played recently')
+async def query_history(ctx, user: Option(str, "Emby user name", autocomplete=history_user_autocomplete),
+                        count: Option(int, "How many plays to show", default=10, min_value=1, max_value=25)):
+    # Answered from the in-memory play history index; Emby's activity log is never queried
+    plays = play_history.recent(user.lower(), count)
+    if not plays:
+        await ctx.respond(f"No plays recorded for {user}.")
+        return
+    multiple_servers = len(servers) > 1
+    lines = [f"<t:{record['t']}:f> - {record['n']}" + (f" ({record['s']})" if multiple_servers else '') for record in plays]
+    embed = discord.Embed(title=f"Recently played by {user}", description='\n'.join(lines)[:4096], color=discord.Color.blue())
+    await ctx.respond(embed=embed)
+
+
+@bot.slash_command(name='top', description='Show the most played items')
+async def query_top(ctx, user: Option(str, "Only count this user's plays", autocomplete=history_user_autocomplete, required=False, default=None),
+                    days: Option(int, "How many days back to count", default=7, min_value=1, max_value=history_index_days)):
+    top_items = play_history.top(days, user.lower() if user else None)
+    if not top_items:
+        await ctx.respond(f"No plays recorded in the last {days} days.")
+        return
+    lines = [f"{rank}. {title} - {plays} play{'s' if plays != 1 else ''}" for rank, (title, plays) in enumerate(top_items, start=1)]
+    title = f"Top plays for {user}" if user else "Top plays"
+    embed = discord.Embed(title=f"{title}, last {days} days", description='\n'.join(lines)[:4096], color=discord.Color.blue())
+    await ctx.respond(embed=embed)
+
+
+async def now_playing_check(server):
+    # While the Emby WebSocket is delivering session events there is nothing to poll for
+    if server.ingest_mode == 'websocket' and server.websocket_connected:
+        return
+
+    global poll_count, poll_profiling
+
+    log.debug("Checking now playing", extra={'server': server.name})
+    poll_count += 1
+    profiler = None
+    if profile_every_polls and poll_count % profile_every_polls == 0 and not poll_profiling:
+        poll_profiling = True
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    result = 'ok'
+    try:
+        with metrics.timer('nowplaying_poll_seconds', server=server.name):
+            status, now_playing_data = await server.fetch_sessions()
+            if status != 200:
+                result = 'http_error'
+                log.warning("Failed to retrieve 'Now Playing' information from Emby", extra={'server': server.name, 'status': status})
+                return
+
+            await process_sessions(server, now_playing_data)
+
+    except EmbyUnavailable:
+        result = 'circuit_open'
+    except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+        result = 'unreachable'
+        log.warning("Emby did not answer the poll", extra={'server': server.name, 'error': repr(e)})
+    except Exception:
+        result = 'error'
+        log.exception("Poll failed", extra={'server': server.name})
+    finally:
+        metrics.inc('nowplaying_polls_total', server=server.name, result=result)
+        update_staleness(server, result == 'ok')
+        if profiler is not None:
+            profiler.disable()
+            poll_profiling = False
+            report_poll_profile(server, profiler)
+
+def update_staleness(server, polled):
+    # While a server's circuit is open its posts keep showing the last known state, marked stale, instead of
+    # being cleared; the first good poll afterwards takes the mark off. Each post is edited once per change.
+    if server.stale_since is None and server.emby.breaker.state == 'open':
+        server.stale_since = datetime.utcnow()
+        log.warning("Emby unreachable, keeping the last known state", extra={'server': server.name})
+    elif server.stale_since is not None and polled:
+        server.stale_since = None
+        log.info("Emby reachable again", extra={'server': server.name})
+    else:
+        return
+
+    if render_mode == 'dashboard':
+        server.dashboard.schedule(server)
+        return
+    for username, state in server.users.items():
+        if state.embed_message is not None and state.embed is not None:
+            server.outbox.submit(f'stale:{username}', lambda state=state: show_staleness(server, state))
+
+async def show_staleness(server, state):
+    stale = server.stale_since is not None
+    if state.stale == stale or state.embed_message is None or state.embed is None:
+        return
+    embed = state.embed
+    if stale:
+        embed = embed.copy()
+        embed.set_footer(text=stale_footer(server))
+    try:
+        # Only the embed changes; the message keeps its attachments
+        await server.outbox.edit(state.embed_message, embed=embed)
+    except discord.NotFound:
+        return
+    state.stale = stale
+
+def stale_footer(server):
+    return f"Emby unreachable since {server.stale_since:%H:%M} UTC - this may be out of date"
+
+def report_poll_profile(server, profiler):
+    # The profiler runs on the event loop thread, so anything other tasks did during the poll is included too
+    output = StringIO()
+    stats = pstats.Stats(profiler, stream=output)
+    stats.sort_stats('cumulative').print_stats(profile_top_functions)
+    log.info("Poll profile for poll %d:\n%s", poll_count, output.getvalue().rstrip(), extra={'server': server.name, 'poll': poll_count})
+    if profile_dir:
+        os.makedirs(profile_dir, exist_ok=True)
+        stats.dump_stats(os.path.join(profile_dir, f'poll-{poll_count}.pstats'))
+
+async def restore_posted_state(server):
+    thread = server.thread
+    await server.message_registry.load()
+    users, values = await server.state_store.load()
+    if not users and not values and not server.message_registry.ids:
+        # Nothing has been recorded yet (first start with a state store), so fall back to a one-off history sweep
+        await sweep_untracked_bot_messages(server)
+        return
+
+    # Reconcile against who is playing right now; if Emby can't be reached, keep everything we know about
+    live_users = None
+    try:
+        status, now_playing_data = await server.fetch_sessions()
+        if status == 200:
+            live_users = {session.get('UserName', '').lower() for session in now_playing_data
+                          if session.get('NowPlayingItem') and server.is_watched(session.get('UserName', '').lower(), session.get('UserId'))}
+    except Exception as e:
+        log.warning("Could not fetch sessions while restoring state", extra={'server': server.name, 'error': str(e)})
+
+    stale_ids = set(server.message_registry.ids)
+    for username, row in users.items():
+        message_ids = [row['embed_message_id'], row['image_message_id']]
+        # Live sessions were matched against the watch list with their Emby user ID, so users watched by ID
+        # are kept too; without them only a match by name is possible
+        if live_users is not None:
+            keep = username in live_users
+        else:
+            keep = server.is_watched(username)
+        if keep:
+            state = server.user_state(username)
+            state.embed_message = await fetch_posted_message(thread, row['embed_message_id'])
+            state.image_message = await fetch_posted_message(thread, row['image_message_id'])
+            state.embed_fingerprint = row['embed_fingerprint']
+            state.image_fingerprint = row['image_fingerprint']
+            # The user is left idle so the next poll renders them again: that rebuilds their embed (needed for the
+            # stale footer) and their claim on the bot's status, and edits these messages in place only if the
+            # post has changed. Rendering the same item again isn't logged as a new play.
+            state.restored_item_id = row['last_item_id']
+            for message in (state.embed_message, state.image_message):
+                if message:
+                    stale_ids.discard(message.id)
+            log.info("Restored now playing messages", extra={'server': server.name, 'user': username})
+        else:
+            stale_ids.update(message_id for message_id in message_ids if message_id)
+            await server.state_store.save_user(username, None, None)
+
+    dashboard_message_ids = values.get('dashboard_message_ids')
+    if dashboard_message_ids and render_mode == 'dashboard':
+        pages = [await fetch_posted_message(thread, int(message_id)) for message_id in dashboard_message_ids.split(',')]
+        server.dashboard.restore([message for message in pages if message])
+        stale_ids.difference_update(message.id for message in server.dashboard.pages)
+    elif dashboard_message_ids:
+        await server.state_store.save_value('dashboard_message_ids', None)
+
+    nothing_message_id = values.get('nothing_message_id')
+    if nothing_message_id:
+        if render_mode == 'dashboard' or live_users:
+            await server.state_store.save_value('nothing_message_id', None)
+        else:
+            server.nothing_message = await fetch_posted_message(thread, int(nothing_message_id))
+            if server.nothing_message:
+                stale_ids.discard(server.nothing_message.id)
 
-        now_playing_data = response.json()
-        active_users = {}
+    # Whatever the bot still owns that isn't part of the restored posts goes in one bulk delete
+    await delete_messages_by_id(server, sorted(stale_ids))
 
+async def fetch_posted_message(thread, message_id):
+    if not message_id:
+        return None
+    try:
+        # Fetched once to check it still exists; only a PartialMessage reference is kept
+        return thread.get_partial_message((await thread.fetch_message(message_id)).id)
+    except discord.NotFound:
+        return None
+
+async def process_sessions(server, now_playing_data):
+    async with server.sessions_lock:
+        # Fingerprint the watched playing sessions first; when it matches the last dispatched one and that
+        # dispatch has settled, the poll is done without touching any per-user state or handler
+        playing_sessions = []
+        fingerprint = []
         for session in now_playing_data:
-            username = session.get('UserName', '').lower()
-            if username in users_ignore or username not in users_watch:
-                continue
-
             item = session.get('NowPlayingItem')
-            if item:
-                print(f"Now Playing Item for user {username}: {item}")  # Uncomment to Print Item details for debugging
-                media_type = item.get('Type').lower()
-                item_id = item.get('Id')
-                active_users[username] = item_id
-                if last_user_info.get(username, {}).get('last_item_id') != item_id:
-                    await handle_media(bot, item, emby_server_ip, emby_server_port, api_key, item_id, username, media_type)
+            if item and server.is_watched(session.get('UserName', '').lower(), session.get('UserId')):
+                playing_sessions.append(session)
+                fingerprint.append((session.get('UserName', '').lower(), item.get('Id'),
+                                    bool((session.get('PlayState') or {}).get('IsPaused'))))
+        fingerprint = tuple(fingerprint)
+
+        server.cadence.observe(playing_sessions)
+        if fingerprint == server.sessions_fingerprint and server.settled(fingerprint):
+            metrics.inc('nowplaying_sessions_unchanged_total', server=server.name)
+            return
+        server.sessions_fingerprint = fingerprint
 
+        active_users = {}
+        changed_users = []
+        for session, (username, item_id, _) in zip(playing_sessions, fingerprint):
+            item = session['NowPlayingItem']
+            log.debug("Now playing item", extra={'server': server.name, 'user': username, 'item': item})  # Full item only at DEBUG
+            media_type = item.get('Type').lower()
+            active_users[username] = item_id
+            if server.user_state(username).item_id != item_id:
+                changed_users.append((session, item, item_id, username, media_type))
+
+        presence_manager.retain(bot, server.name, active_users)
+
+        if render_mode == 'dashboard':
+            # The dashboard shows its own empty state, so there is no 'Nothing Playing' post; users who
+            # stopped simply drop off it
+            for username, state in server.users.items():
+                if username not in active_users and state.state == 'playing':
+                    state.stop()
+                    server.dashboard.schedule(server)
         # Handle "Nothing Playing" if no active users are detected
-        if not active_users:
-            if not last_global_nothing_message:
-                last_global_nothing_message = await send_nothing_playing_message()
-                print("Displayed 'Nothing Playing' message.")
+        elif not active_users:
+            if not server.nothing_message:
+                # Anything still queued for a user would be wiped by the 'Nothing Playing' post anyway. A user
+                # whose post never went out goes back to idle, so their item is rendered if it comes straight back.
+                for slot in server.outbox.clear_pending():
+                    state = server.users.get(slot)
+                    if state is not None and state.state == 'playing':
+                        state.stop()
+                server.outbox.submit('nothing', lambda: send_nothing_playing_message(server))
         else:
-            if last_global_nothing_message:
-                await last_global_nothing_message.delete()
-                last_global_nothing_message = None
-                print("Removed 'Nothing Playing' message.")
-
-    except Exception as e:
-        print(f"An error occurred: {str(e)}")
-
-async def clear_all_bot_messages():
-    global last_user_info, bot
+            # Drop a 'Nothing Playing' post that hasn't gone out yet, or remove the one that has
+            server.outbox.discard('nothing')
+            if server.nothing_message:
+                server.outbox.submit('nothing', lambda: clear_nothing_playing_message(server))
+
+    # Users are handled concurrently and outside the sessions lock, so one slow image fetch only holds up
+    # its own user; the per-user lock keeps each user's updates in order
+    await asyncio.gather(*(handle_user_media(server, session, item, item_id, username, media_type)
+                           for session, item, item_id, username, media_type in changed_users))
+
+async def handle_user_media(server, session, item, item_id, username, media_type):
+    async with server.user_locks[username]:
+        try:
+            with metrics.timer('nowplaying_handler_seconds', media_type=media_type):
+                await handle_media(server, item, item_id, username, media_type)
+        except Exception:
+            metrics.inc('nowplaying_handler_errors_total', media_type=media_type)
+            log.exception("Failed to handle media", extra={'server': server.name, 'user': username, 'item_id': item_id})
+
+    # Get the next track's artwork and embed ready while this one plays (the dashboard needs neither)
+    if media_type == 'audio' and render_mode != 'dashboard':
+        schedule_prefetch(server, session, username)
+
+def schedule_prefetch(server, session, username):
+    running = server.prefetch_tasks.get(username)
+    if running and not running.done():
+        running.cancel()  # The user moved on, so the old guess is no longer useful
+    server.prefetch_tasks[username] = asyncio.create_task(prefetch_next_item(server, session, username))
+
+async def prefetch_next_item(server, session, username):
+    emby = server.emby
+    try:
+        user_id = session.get('UserId')
+        if not user_id:
+            return
 
-    # Iterate through all users and clear messages
-    for username, user_info in last_user_info.items():
-        if user_info.get('last_embed_message'):
-            try:
-                await user_info['last_embed_message'].delete()
-            except discord.NotFound:
-                pass
-            user_info['last_embed_message'] = None
+        next_item_id = find_next_queue_item_id(session)
+        if next_item_id:
+            status, next_item = await emby.get_json(f'/Users/{user_id}/Items/{next_item_id}')
+        else:
+            # No play queue in the session, so guess the next track on the album
+            next_item = await find_next_album_track(emby, user_id, session['NowPlayingItem'])
 
-        if user_info.get('last_image_message'):
-            try:
-                await user_info['last_image_message'].delete()
-            except discord.NotFound:
-                pass
-            user_info['last_image_message'] = None
+        if not next_item or (next_item.get('Type') or '').lower() != 'audio':
+            return
 
-    # Also clear the global "Nothing Playing" message if it exists
-    if hasattr(bot, 'last_global_nothing_message') and bot.last_global_nothing_message:
+        # Building the view fetches (and caches) the artwork, and the card in card mode, so the post is ready to go
+        view = await present_view(server, await build_audio_view(next_item, emby), next_item['Id'])
+        server.prefetched_views[username] = (next_item['Id'], view)
+        log.debug("Prefetched next track", extra={'user': username, 'item_id': next_item['Id']})
+    except asyncio.CancelledError:
+        raise
+    except Exception as e:
+        log.warning("Failed to prefetch next track", extra={'user': username, 'error': str(e)})
+
+def find_next_queue_item_id(session):
+    queue = session.get('NowPlayingQueue') or []
+    playlist_item_id = session.get('PlaylistItemId')
+    current_item_id = session['NowPlayingItem'].get('Id')
+    for index, entry in enumerate(queue):
+        if (entry.get('PlaylistItemId') == playlist_item_id) if playlist_item_id else (entry.get('Id') == current_item_id):
+            return queue[index + 1].get('Id') if index + 1 < len(queue) else None
+    return None
+
+async def find_next_album_track(emby, user_id, item):
+    album_id = item.get('AlbumId')
+    if not album_id:
+        return None
+    params = {
+        'ParentId': album_id,
+        'IncludeItemTypes': 'Audio',
+        'Recursive': 'true',
+        'SortBy': 'ParentIndexNumber,IndexNumber,SortName',
+    }
+    status, tracks = await emby.get_json(f'/Users/{user_id}/Items', params=params)
+    if status != 200:
+        return None
+    track_ids = [track.get('Id') for track in tracks.get('Items', [])]
+    if item.get('Id') in track_ids:
+        index = track_ids.index(item.get('Id'))
+        if index + 1 < len(track_ids):
+            return tracks['Items'][index + 1]
+    return None
+
+def take_prefetched_view(server, username, item_id):
+    # The prefetched view is only used if the guess was right
+    prefetched = server.prefetched_views.pop(username, None)
+    if prefetched and prefetched[0] == item_id:
+        log.debug("Using prefetched view", extra={'user': username, 'item_id': item_id})
+        return prefetched[1]
+    return None
+
+async def emby_websocket_listener(server):
+    delay = websocket_reconnect_delay
+    while True:
         try:
-            await bot.last_global_nothing_message.delete()
-        except discord.NotFound:
-            pass
-        bot.last_global_nothing_message = None
+            async with server.emby.websocket() as ws:
+                # Ask Emby to push the session list whenever it changes (initial delay 0 ms, interval 1500 ms)
+                await ws.send_json({'MessageType': 'SessionsStart', 'Data': '0,1500'})
+                server.websocket_connected = True
+                delay = websocket_reconnect_delay
+                log.info("Connected to Emby WebSocket, polling paused", extra={'server': server.name})
+
+                keepalive_task = asyncio.create_task(send_websocket_keepalive(ws))
+                try:
+                    async for msg in ws:
+                        if msg.type == aiohttp.WSMsgType.TEXT:
+                            await handle_websocket_message(server, json.loads(msg.data))
+                        elif msg.type == aiohttp.WSMsgType.ERROR:
+                            break
+                finally:
+                    keepalive_task.cancel()
+        except asyncio.CancelledError:
+            server.websocket_connected = False
+            raise
+        except Exception as e:
+            log.warning("Emby WebSocket error", extra={'server': server.name, 'error': repr(e)})
+
+        if server.websocket_connected:
+            log.warning("Emby WebSocket dropped, falling back to polling", extra={'server': server.name})
+            poll_scheduler.poll_soon(server)
+        server.websocket_connected = False
+
+        await asyncio.sleep(delay)
+        delay = min(delay * 2, websocket_max_reconnect_delay)
+
+async def send_websocket_keepalive(ws):
+    while not ws.closed:
+        await asyncio.sleep(websocket_keepalive_interval)
+        await ws.send_json({'MessageType': 'KeepAlive'})
+
+async def handle_websocket_message(server, message):
+    message_type = message.get('MessageType')
+
+    if message_type == 'Sessions':
+        # Same payload as GET /Sessions, so it feeds the same dispatch
+        try:
+            await process_sessions(server, message.get('Data') or [])
+        except Exception:
+            log.exception("Failed to process pushed sessions", extra={'server': server.name})
+    elif message_type in ('PlaybackStart', 'PlaybackStopped', 'SessionEnded'):
+        # Playback events only carry part of the session, so fetch the full list right away
+        try:
+            status, now_playing_data = await server.fetch_sessions()
+            if status == 200:
+                await process_sessions(server, now_playing_data)
+        except Exception:
+            log.exception("Failed to refresh sessions after playback event", extra={'server': server.name, 'message_type': message_type})
 
-    print("Cleared all bot messages.")
+async def clear_all_bot_messages(server):
+    # Delete everything the bot has posted in one go, then drop the references
+    await delete_messages_by_id(server, sorted(server.message_registry.ids))
 
-async def handle_nothing(username):
-    global last_user_info, bot  # Ensure 'bot' is accessible
+    for username, state in server.users.items():
+        state.forget_messages()
+        await server.state_store.save_user(username, state, None)
 
-    # Check and initialize user info if not present
-    if username not in last_user_info:
-        last_user_info[username] = {
-            'last_item_id': None,
-            'last_embed_message': None,  # Updated to use last_embed_message
-        }
+    # Also clear the global "Nothing Playing" message reference
+    server.nothing_message = None
+    await server.state_store.save_value('nothing_message_id', None)
 
-    # Path to the image file
-    image_path = './ASSETS/Nothing_Playing.jpg'
-    file = discord.File(image_path, filename='Nothing_Playing.jpg')
+    log.info("Cleared all bot messages", extra={'server': server.name})
 
-    # Create an embed with the image
+async def handle_nothing(server, username):
+    # Create an embed with the 'Nothing Playing' image
     embed = discord.Embed(title="\u200B", color=discord.Color.blue())  # Invisible character as title
     embed.set_image(url="attachment://Nothing_Playing.jpg")
+    view = NowPlayingView(embed, ('Nothing_Playing.jpg', load_asset('Nothing_Playing.jpg')))
 
-    # Delete the previous embed message for the user, if any
-    if 'last_embed_message' in last_user_info[username] and last_user_info[username]['last_embed_message']:
-        try:
-            await last_user_info[username]['last_embed_message'].delete()
-            print(f"Deleted last embed message for {username}.")
-        except discord.NotFound:
-            print(f"No previous embed message found for {username}.")
-
-    # Debug output
-    print("Sending 'Nothing Playing' message to thread:", bot.now_playing_thread.id)
+    log.debug("Queueing 'Nothing Playing' for user", extra={'server': server.name, 'user': username, 'thread_id': server.thread.id})
 
-    # Send the new message and update last_user_info
-    try:
-        new_embed_message = await bot.now_playing_thread.send(embed=embed, file=file)
-        last_user_info[username]['last_embed_message'] = new_embed_message  # Update to store the new embed message
-        last_user_info[username]['last_item_id'] = None
-        print(f"Sent 'Nothing Playing' message for {username}.")
-    except Exception as e:
-        print(f"Error sending 'Nothing Playing' message for {username}:", str(e))
-
-async def send_nothing_playing_message():
-    global last_user_info, last_global_nothing_message, bot  # Ensure 'bot' is accessible
+    # Queue the user's messages to be replaced with the 'Nothing Playing' embed and update the user's state
+    server.outbox.submit(username, lambda: render_user_view(server, username, view))
+    server.user_state(username).show_nothing()
 
-    # Clear all messages from the bot before posting 'Nothing Playing'
-    async for message in bot.now_playing_thread.history(limit=10):  # Adjust the limit based on your needs
-        if message.author == bot.user and not message.is_system():
-            await message.delete()
+async def send_nothing_playing_message(server):
+    # Clear all messages from the bot before posting 'Nothing Playing', by ID and in bulk
+    await delete_messages_by_id(server, sorted(server.message_registry.ids))
 
-    # Prepare the 'Nothing Playing' image and embed
-    image_path = './ASSETS/Nothing_Playing.jpg'
-    file = discord.File(image_path, filename='Nothing_Playing.jpg')
+    # Prepare the 'Nothing Playing' image and embed; with an artwork store the image is only ever uploaded once
     embed = discord.Embed(title="\u200B", color=discord.Color.blue())  # Invisible character as title
     embed.set_image(url="attachment://Nothing_Playing.jpg")
+    embed, attachment, _, _ = await artwork_store.link(NowPlayingView(embed, ('Nothing_Playing.jpg', load_asset('Nothing_Playing.jpg'))))
+    file = discord.File(BytesIO(attachment[1]), filename=attachment[0]) if attachment else None
 
-    # Clear references to previous messages stored in last_user_info
-    for username, user_info in last_user_info.items():
-        user_info['last_embed_message'] = None
-        user_info['last_image_message'] = None  # Assuming you have this reference in your user_info
+    # Clear references to previous messages stored for each user; everyone is idle again, so a user
+    # coming back to the same item gets a fresh post
+    for username, state in server.users.items():
+        state.forget_messages()
+        await server.state_store.save_user(username, state, None)
 
     # Send the global "Nothing Playing" message and update the reference
-    last_global_nothing_message = await bot.now_playing_thread.send(embed=embed, file=file)
-    print(f"Sent 'Nothing Playing' message. Message ID: {last_global_nothing_message.id}")
+    server.nothing_message = server.partial_message(await server.outbox.send(embed=embed, file=file))
+    await server.state_store.save_value('nothing_message_id', server.nothing_message.id)
+    log.info("Sent 'Nothing Playing' message", extra={'server': server.name, 'message_id': server.nothing_message.id})
 
-    # Update the bot's status to "Nothing"
-    await bot.change_presence(activity=discord.Game(name="Nothing"))
-    print("Updated bot status to 'Nothing'.")
+    # Nobody on this server is playing, so its claims on the bot's status go
+    presence_manager.clear(bot, server.name)
 
-    return last_global_nothing_message
+    return server.nothing_message
 
 
-async def clear_nothing_playing_message():
-    global last_global_nothing_message, bot
-
-    if hasattr(bot, 'last_global_nothing_message') and bot.last_global_nothing_message:
+async def clear_nothing_playing_message(server):
+    if server.nothing_message:
         try:
-            await bot.last_global_nothing_message.delete()
-            print("Deleted 'Nothing Playing' message.")
+            await server.outbox.delete(server.nothing_message)
+            log.info("Deleted 'Nothing Playing' message", extra={'server': server.name})
         except discord.NotFound:
-            print("Nothing Playing message already deleted.")
-        bot.last_global_nothing_message = None
-
+            log.info("'Nothing Playing' message already deleted", extra={'server': server.name})
+        server.nothing_message = None
+        await server.state_store.save_value('nothing_message_id', None)
 
-async def handle_nothing_playing(current_active_users):
-    global last_user_info, last_global_nothing_message, bot
 
-    print(f"Handling 'Nothing Playing'. Current active users: {current_active_users}")
+async def handle_nothing_playing(server, current_active_users):
+    log.info("Handling 'Nothing Playing'", extra={'server': server.name, 'active_users': sorted(current_active_users)})
 
     if not current_active_users:
         # Send the 'Nothing Playing' message which now also clears all bot messages before posting
-        last_global_nothing_message = await send_nothing_playing_message()
-        print(f"Sent 'Nothing Playing' message. Message ID: {last_global_nothing_message.id}")
+        await send_nothing_playing_message(server)
     else:
         # If there are active users but the 'Nothing Playing' message is still showing, delete it
-        if last_global_nothing_message:
+        await clear_nothing_playing_message(server)
+
+
+
+async def clear_bot_messages_in_channel(server):
+    # This function will delete all messages the bot has posted in the server's thread, by ID
+    deleted_count = await delete_messages_by_id(server, sorted(server.message_registry.ids))
+    log.info("Cleared bot messages in the channel", extra={'server': server.name, 'deleted': deleted_count})
+
+async def sweep_untracked_bot_messages(server):
+    # Only for messages posted before the registry existed: one history fetch, then bulk delete
+    message_ids = [message.id async for message in server.thread.history(limit=200) if message.author == bot.user]
+    deleted_count = await delete_messages_by_id(server, message_ids)
+    log.info("Cleared untracked bot messages in the channel", extra={'server': server.name, 'deleted': deleted_count})
+
+async def delete_messages_by_id(server, message_ids):
+    # Messages inside Discord's bulk window go in bulk deletes of up to 100; older ones (or a bulk delete
+    # Discord refuses) are deleted one by one, concurrently, with the outbox's delete bucket pacing them
+    if not message_ids:
+        return 0
+
+    channel = server.thread
+    outbox = server.outbox
+    cutoff = discord.utils.utcnow() - bulk_delete_max_age
+    recent_ids = [message_id for message_id in message_ids if discord.utils.snowflake_time(message_id) > cutoff]
+    single_ids = [message_id for message_id in message_ids if discord.utils.snowflake_time(message_id) <= cutoff]
+
+    for start in range(0, len(recent_ids), 100):
+        chunk = recent_ids[start:start + 100]
+        if len(chunk) == 1:
+            single_ids.extend(chunk)
+            continue
+        messages = [channel.get_partial_message(message_id) for message_id in chunk]
+        try:
+            await outbox.call('delete', lambda: channel.delete_messages(messages))
+            await server.message_registry.discard(chunk)
+        except discord.HTTPException as e:
+            log.warning("Bulk delete failed, deleting individually", extra={'server': server.name, 'error': str(e)})
+            single_ids.extend(chunk)
+
+    await asyncio.gather(*(delete_message_quietly(server, channel.get_partial_message(message_id)) for message_id in single_ids))
+    return len(message_ids)
+
+async def delete_message_quietly(server, message):
+    try:
+        await server.outbox.delete(message)
+    except discord.NotFound:
+        pass
+    except discord.HTTPException as e:
+        log.warning("Failed to delete message", extra={'server': server.name, 'message_id': message.id, 'error': str(e)})
+
+class NowPlayingView:
+    # Desired state of one user's now-playing slot: the embed message (optionally carrying an attached
+    # thumbnail) followed by an optional standalone image message. Attachments are (filename, bytes) pairs.
+    # tags are the Emby image tags of the two attachments (None where the image has no tag), used to key cards;
+    # keys identify the two images for the artwork store (None to key an image by its content).
+    def __init__(self, embed, embed_attachment=None, image_attachment=None, status=None, tags=(None, None), media_type=None,
+                 keys=(None, None)):
+        self.embed = embed
+        self.embed_attachment = embed_attachment
+        self.image_attachment = image_attachment
+        self.status = status  # Bot presence text, or None to make no claim on the presence
+        self.tags = tags
+        self.keys = keys
+        self.media_type = media_type  # Ranks the status against other users' (see PresenceManager)
+        self.is_card = False
+
+
+def card_cache_key(item_id, view):
+    # Keyed on the item and its image tags; an image without a tag is identified by its content instead
+    parts = [view.embed.title or '', view.embed.description or '', f'{card_size}:{card_quality}']
+    for tag, attachment in zip(view.tags, (view.embed_attachment, view.image_attachment)):
+        if tag:
+            parts.append(tag)
+        elif attachment:
+            parts.append(hashlib.sha256(attachment[1]).hexdigest())
+        else:
+            parts.append('')
+    return (item_id, 'Card', hashlib.sha256('\0'.join(parts).encode('utf-8')).hexdigest(), 'card')
+
+
+async def present_view(server, view, item_id):
+    # In card mode, turn a two-message view into a single message carrying one composited image.
+    # Cards go through the artwork cache, so replaying an item (or a prefetched track) costs no compositing.
+    if render_mode != 'card' or Image is None or view is None or view.is_card:
+        return view
+
+    key = card_cache_key(server.emby.cache_key(item_id), view)
+    card = await artwork_cache.get(key)
+    if card is None:
+        title = view.embed.title or ''
+        text = (view.embed.description or '').replace('**', '')
+        poster = view.embed_attachment[1] if view.embed_attachment else None
+        background = view.image_attachment[1] if view.image_attachment else None
+        try:
+            with metrics.timer('nowplaying_card_render_seconds'):
+                loop = asyncio.get_running_loop()
+                card = await loop.run_in_executor(get_artwork_process_pool(), compose_card, title, text, poster,
+                                                  background, card_size, card_quality)
+        except Exception as e:
+            log.warning("Failed to render card, posting separate messages", extra={'server': server.name, 'item_id': item_id, 'error': repr(e)})
+            return view
+        await artwork_cache.put(key, card)
+
+    embed = discord.Embed(title=view.embed.title, color=view.embed.color)
+    embed.set_image(url="attachment://now_playing_card.jpg")
+    card_view = NowPlayingView(embed, ('now_playing_card.jpg', card), status=view.status, media_type=view.media_type,
+                               keys=(key, None))
+    card_view.is_card = True
+    return card_view
+
+
+asset_cache = {}
+
+
+def load_asset(filename):
+    # Placeholder images from ./ASSETS, read once and kept in memory
+    if filename not in asset_cache:
+        with open(os.path.join('./ASSETS', filename), 'rb') as f:
+            asset_cache[filename] = f.read()
+    return asset_cache[filename]
+
+
+def message_fingerprint(embed, attachment):
+    # Identifies what a message shows, so an unchanged message is never touched
+    digest = hashlib.sha1()
+    if embed is not None:
+        digest.update(json.dumps(embed.to_dict(), sort_keys=True, default=str).encode())
+    if attachment is not None:
+        digest.update(attachment[0].encode())
+        digest.update(attachment[1])
+    return digest.hexdigest()
+
+
+async def sync_message(server, message, old_fingerprint, embed, attachment):
+    # Brings one posted message in line with the desired embed/attachment using the fewest calls:
+    # nothing if it already matches, an in-place edit if it exists, a send if it doesn't, a delete if it
+    # is no longer wanted. Returns the (message, fingerprint) now in place.
+    outbox = server.outbox
+    if embed is None and attachment is None:
+        if message:
             try:
-                await last_global_nothing_message.delete()
-                print("Deleted 'Nothing Playing' message.")
+                await outbox.delete(message)
             except discord.NotFound:
-                print("Nothing Playing message already deleted.")
-            finally:
-                last_global_nothing_message = None  # Clear the reference
+                pass
+        return None, None
+
+    fingerprint = message_fingerprint(embed, attachment)
+    if message and fingerprint == old_fingerprint:
+        return message, fingerprint
 
+    if message:
+        edit_fields = {'embed': embed, 'attachments': []}
+        if attachment is not None:
+            edit_fields['file'] = discord.File(BytesIO(attachment[1]), filename=attachment[0])
+        try:
+            return await outbox.edit(message, **edit_fields), fingerprint
+        except discord.NotFound:
+            pass  # Deleted by hand in the meantime, so post it again below
+
+    file = discord.File(BytesIO(attachment[1]), filename=attachment[0]) if attachment is not None else None
+    new_message = await outbox.send(embed=embed, file=file)
+    return new_message, fingerprint
+
+
+async def render_user_view(server, username, view, item_id=None):
+    state = server.user_state(username)
+    embed, embed_attachment, image_embed, image_attachment = await artwork_store.link(view) if view else (None, None, None, None)
+
+    # The stale footer isn't part of the fingerprint, so a post marked stale is always rewritten
+    embed_message, state.embed_fingerprint = await sync_message(
+        server, state.embed_message, None if state.stale else state.embed_fingerprint, embed, embed_attachment)
+    state.embed_message = server.partial_message(embed_message)
+    state.embed = embed
+    state.stale = False
+    image_message, state.image_fingerprint = await sync_message(
+        server, state.image_message, state.image_fingerprint, image_embed, image_attachment)
+    state.image_message = server.partial_message(image_message)
+    await server.state_store.save_user(username, state, item_id)
+
+    if view and view.status:
+        presence_manager.claim(bot, server.name, username, view.status, view.media_type)
+    else:
+        presence_manager.release(bot, server.name, username)
 
 
-async def clear_bot_messages_in_channel(channel):
-    # This function will delete all messages sent by the bot in a specified channel
-    deleted_count = 0  # Counter for deleted messages
-    async for message in channel.history(limit=200):  # Adjust limit as needed
-        if message.author == bot.user:
+async def render_or_reset(server, username, view, item_id, play):
+    # The user is marked as playing the item as soon as its render is queued. If the render then fails, the
+    # post never went out, so put the user back to idle and let the next poll render the item again.
+    # play is (media type, title) for the play history.
+    state = server.user_state(username)
+    try:
+        await render_user_view(server, username, view, item_id)
+    except Exception:
+        if state.state == 'playing' and state.item_id == item_id:
+            state.stop()
+        raise
+    media_type, title = play
+    if media_type != 'nothing' and item_id != state.restored_item_id:
+        play_history.record(server.name, username, item_id, media_type, title)
+    state.restored_item_id = None
+
+
+class Dashboard:
+    # Dashboard mode: every active session is a field (built from the server's users) on one embed that is
+    # edited in place. Fields that don't fit in one embed spill onto further pages, each its own pinned
+    # message. Changes only mark the dashboard dirty; it is re-rendered at most once per interval.
+    def __init__(self, interval):
+        self.interval = interval
+        self.pages = []  # Posted messages, one per page
+        self.fingerprints = []
+        self.dirty = False
+        self.last_render = None  # Loop time of the last render
+        self.task = None
+
+    def restore(self, pages):
+        self.pages = list(pages)
+        self.fingerprints = [None] * len(self.pages)
+
+    def schedule(self, server):
+        self.dirty = True
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.flush(server))
+
+    async def flush(self, server):
+        loop = asyncio.get_running_loop()
+        while self.dirty:
+            if self.last_render is not None:
+                wait = self.last_render + self.interval - loop.time()
+                if wait > 0:
+                    await asyncio.sleep(wait)
+            self.dirty = False
+            self.last_render = loop.time()
             try:
-                await message.delete()
-                deleted_count += 1
-            except discord.NotFound:
-                # If the message is already deleted, just continue
-                continue
-    print(f"Cleared {deleted_count} bot messages in the channel.")
-    
-async def handle_media(bot, item, emby_server_ip, emby_server_port, api_key, item_id, username, media_type):
-    global last_user_info
+                await self.render(server)
+            except Exception:
+                log.exception("Failed to update dashboard", extra={'server': server.name})
+
+    def build_pages(self, server):
+        fields = sorted(state.dashboard_field for state in server.users.values() if state.dashboard_field)
+        if not fields:
+            return [discord.Embed(title="Now Playing", description="Nothing is playing right now.", color=discord.Color.blue())]
+
+        chunks = [[]]
+        size = 0
+        for name, value in fields:
+            if len(chunks[-1]) >= dashboard_fields_per_page or (chunks[-1] and size + len(name) + len(value) > dashboard_chars_per_page):
+                chunks.append([])
+                size = 0
+            chunks[-1].append((name, value))
+            size += len(name) + len(value)
+
+        pages = []
+        for number, chunk in enumerate(chunks, start=1):
+            title = "Now Playing" if len(chunks) == 1 else f"Now Playing ({number}/{len(chunks)})"
+            embed = discord.Embed(title=title, color=discord.Color.blue())
+            for name, value in chunk:
+                embed.add_field(name=name, value=value, inline=False)
+            pages.append(embed)
+        return pages
+
+    async def render(self, server):
+        embeds = self.build_pages(server)
+        if server.stale_since is not None:
+            for embed in embeds:
+                embed.set_footer(text=stale_footer(server))
+        pages = self.pages + [None] * (len(embeds) - len(self.pages))
+        fingerprints = self.fingerprints + [None] * (len(pages) - len(self.fingerprints))
+        for index, message in enumerate(pages):
+            embed = embeds[index] if index < len(embeds) else None
+            new_message, fingerprints[index] = await sync_message(server, message, fingerprints[index], embed, None)
+            new_message = server.partial_message(new_message)
+            if new_message is not None and (message is None or new_message.id != message.id):
+                await pin_message(server, new_message)
+            pages[index] = new_message
+        self.pages = [message for message in pages if message is not None]
+        self.fingerprints = [fingerprint for message, fingerprint in zip(pages, fingerprints) if message is not None]
+        await server.state_store.save_value('dashboard_message_ids', ','.join(str(message.id) for message in self.pages) or None)
+
+
+
+async def pin_message(server, message):
+    # Pinning keeps the dashboard pages easy to find in a busy thread; it needs Manage Messages
+    try:
+        await server.outbox.call('edit', lambda: message.pin())
+    except discord.HTTPException as e:
+        log.warning("Could not pin dashboard page", extra={'server': server.name, 'message_id': message.id, 'error': str(e)})
+
+
+def dashboard_field(username, item, media_type):
+    # (field name, field value) for one session; Discord caps these at 256 and 1024 characters
+    name = item.get('Name', 'Unknown')
+    year = item.get('ProductionYear')
+    if media_type == 'episode':
+        value = f"{item.get('SeriesName', 'Unknown Series')} - S{item.get('ParentIndexNumber', 0):02}E{item.get('IndexNumber', 0):02}: {name}"
+    elif media_type == 'movie':
+        value = f"{name} ({year})" if year else name
+    elif media_type == 'audio':
+        artists = item.get('Artists') or ['Unknown Artist']
+        value = f"{artists[0]}: {name}\n*{item.get('Album', 'Unknown Album')}*"
+    else:
+        value = f"{name} ({media_type})"
+    return (f"{username} \u00b7 {item.get('Type', media_type)}"[:256], value[:1024])
 
-    print(f"Handling media for user {username}. Media type: {media_type}")
 
+async def handle_media(server, item, item_id, username, media_type):
+    log.info("Handling media", extra={'server': server.name, 'user': username, 'media_type': media_type, 'item_id': item_id})
+
+    emby = server.emby
     current_time = datetime.utcnow()
     media_type = media_type.lower()
+    state = server.user_state(username)
 
     # Check if the media type is 'nothing' or if the item has stopped/restarted
-    if media_type == 'nothing' or last_user_info[username]['last_item_id'] != item_id:
+    if media_type == 'nothing' or state.item_id != item_id:
         # Update the timestamp regardless of the media type
-        last_user_info[username]['last_update_time'] = current_time
-
-        # Delete both embed and image messages for the user
-        if 'last_embed_message' in last_user_info[username] and last_user_info[username]['last_embed_message']:
-            try:
-                await last_user_info[username]['last_embed_message'].delete()
-            except discord.NotFound:
-                pass
-            last_user_info[username]['last_embed_message'] = None
-
-        if 'last_image_message' in last_user_info[username] and last_user_info[username]['last_image_message']:
-            try:
-                await last_user_info[username]['last_image_message'].delete()
-            except discord.NotFound:
-                pass
-            last_user_info[username]['last_image_message'] = None
+        state.updated_at = current_time
+
+        if render_mode == 'dashboard':
+            # No per-user messages or artwork: the session becomes a field on the shared dashboard
+            state.play(item_id)
+            state.dashboard_field = dashboard_field(username, item, media_type)
+            presence_manager.claim(bot, server.name, username, state.dashboard_field[1].split('\n')[0], media_type)
+            await server.state_store.save_user(username, state, item_id)
+            server.dashboard.schedule(server)
+            if media_type != 'nothing' and item_id != state.restored_item_id:
+                play_history.record(server.name, username, item_id, media_type, state.dashboard_field[1].split('\n')[0])
+            state.restored_item_id = None
+            return
 
-        # Determine the type of media and call the appropriate handler
+        # Determine the type of media and build the view for it; the renderer edits the user's existing
+        # messages in place rather than deleting and re-sending them
         if media_type == 'movie':
-            await handle_movie(bot, item, emby_server_ip, emby_server_port, api_key, item_id, username)
+            view = await build_movie_view(item, emby, item_id)
         elif media_type == 'episode':
-            await handle_episode(bot, item, emby_server_ip, emby_server_port, api_key, username)
+            view = await build_episode_view(item, emby)
         elif media_type == 'audio':
-            await handle_audio(bot, item, emby_server_ip, emby_server_port, api_key, username)
+            view = take_prefetched_view(server, username, item_id) or await build_audio_view(item, emby)
         elif media_type == 'musicvideo':
-            await handle_music_video(bot, item, emby_server_ip, emby_server_port, api_key, username)
+            view = await build_music_video_view(item, emby)
         elif media_type == 'audiobook':
-            await handle_audio_book(bot, item, username)
+            view = build_audio_book_view(item)
         else:
-            await handle_generic_media(bot, item, username, media_type)
+            view = build_generic_media_view(item, media_type)
+
+        view = await present_view(server, view, item_id)
+
+        # Queue the render; a newer change for this user before the queue flushes replaces it. The play is
+        # logged once the post is out, so a render that fails and is retried is only recorded once.
+        title = dashboard_field(username, item, media_type)[1].split('\n')[0]
+        server.outbox.submit(username, lambda: render_or_reset(server, username, view, item_id, (media_type, title)))
 
         # Update the last item ID for this user
-        last_user_info[username]['last_item_id'] = item_id
+        state.play(item_id)
     else:
         # If the same item is playing and it hasn't been long enough, don't update
-        last_update_time = last_user_info[username].get('last_update_time', datetime.utcfromtimestamp(0))
+        last_update_time = state.updated_at or datetime.utcfromtimestamp(0)
         if current_time - last_update_time < timedelta(seconds=10):
             return
 
 
-async def handle_episode(bot, item, emby_server_ip, emby_server_port, api_key, username):
-    global last_user_info
-
-    # Call this function to clear the "Nothing Playing" message before proceeding
-    await clear_nothing_playing_message()
-
-    # Initialize last_user_info for the user if not already done
-    if username not in last_user_info:
-        last_user_info[username] = {
-            'last_item_id': None,
-            'last_embed_message': None,  # For tracking the latest message
-        }
-
+async def build_episode_view(item, emby):
     series_title = item.get('SeriesName', 'Unknown Series')
     title = item.get('Name')
     episode_number = item.get('IndexNumber', 'Unknown Episode')
     season_number = item.get('ParentIndexNumber', 'Unknown Season')
 
-    # Extract the show directory path from the network share
-    item_path = item.get('Path')
-    show_directory = os.path.dirname(os.path.dirname(item_path))  # Go up two levels to get to the show directory
-
-    # Check if the folder.jpg exists, if not use Series_Missing.jpg
-    folder_image_path = os.path.join(show_directory, 'folder.jpg')
-    if os.path.exists(folder_image_path):
-        file = discord.File(folder_image_path, filename='folder_image.jpg')
-    else:
-        file = discord.File('./ASSETS/Series_Missing.jpg', filename='Series_Missing.jpg')
+    # The series thumbnail comes from folder.jpg on the network share; the episode's primary image goes in a
+    # separate message after the embed. Both are fetched side by side.
+    thumbnail, image_data = await asyncio.gather(
+        fetch_series_thumbnail(item, emby),
+        fetch_artwork(emby, item['Id'], 'Primary', item.get('ImageTags', {}).get('Primary'), slot='image'),
+    )
 
     embed_title = f"{series_title} - S{season_number:02}E{episode_number:02}: {title}"
     overview = item.get('Overview', 'No overview available')
     embed = discord.Embed(title=embed_title, description=f"**Overview:** {overview}", color=discord.Color.blue())
-    embed.set_thumbnail(url="attachment://folder_image.jpg" if os.path.exists(folder_image_path) else "attachment://Series_Missing.jpg")
+    embed.set_thumbnail(url=f"attachment://{thumbnail[0]}")
 
-    # Update the bot's status message
-    await bot.change_presence(activity=discord.Game(name=embed_title))
-    
-    # Delete the previous embed message for the user, if any
-    if 'last_embed_message' in last_user_info[username] and last_user_info[username]['last_embed_message']:
-        try:
-            await last_user_info[username]['last_embed_message'].delete()
-            print(f"Deleted last embed message for {username} (episode).")
-        except discord.NotFound:
-            print(f"No previous message found to delete for {username}.")
-
-    # Send the new embed message and update last_user_info
-    new_embed_message = await bot.now_playing_thread.send(embed=embed, file=file)
-    last_user_info[username]['last_embed_message'] = new_embed_message
-    print(f"Sent new episode message for {username}.")
-
-    # For sending the episode's primary image as a separate message after the embed
-    # Assume the primary image URL is constructed similarly to how we've done before
-    episode_primary_image_url = f"http://{emby_server_ip}:{emby_server_port}/emby/Items/{item['Id']}/Images/Primary?api_key={api_key}"
-    async with aiohttp.ClientSession() as session:
-        async with session.get(episode_primary_image_url) as response:
-            if response.status == 200:
-                image_data = await response.read()
-                await bot.now_playing_thread.send(file=discord.File(BytesIO(image_data), filename="episode_primary_image.jpg"))
-
-async def handle_movie(bot, item, emby_server_ip, emby_server_port, api_key, item_id, username):
-    global last_user_info
-
-    # Call this function to clear the "Nothing Playing" message before proceeding
-    await clear_nothing_playing_message()
-
-    # Ensure the user info structure is initialized properly
-    if username not in last_user_info:
-        last_user_info[username] = {
-            'last_item_id': None,
-            'last_update_time': datetime.min,
-            'last_embed_message': None,
-            'last_image_message': None,  # For tracking the latest primary image message
-        }
+    image = ('episode_primary_image.jpg', image_data) if image_data else None
 
+    return NowPlayingView(embed, thumbnail, image, status=embed_title, tags=(None, item.get('ImageTags', {}).get('Primary')),
+                          media_type='episode',
+                          keys=(None, artwork_key(emby, item['Id'], 'Primary', item.get('ImageTags', {}).get('Primary'), 'image')))
+
+async def build_movie_view(item, emby, item_id):
     title = item.get('Name')
     year = item.get('ProductionYear', 'Unknown Year')
 
-    # Construct the primary image URL with the item_id
-    primary_image_url = f'http://{emby_server_ip}:{emby_server_port}/emby/Items/{item_id}/Images/Primary?api_key={api_key}'
-    backdrop_image_url = f'http://{emby_server_ip}:{emby_server_port}/emby/Items/{item_id}/Images/Backdrop/0?api_key={api_key}'
-
-    async with aiohttp.ClientSession() as session:
-        # Fetch the primary image
-        primary_image_response = await session.get(primary_image_url)
-        if primary_image_response.status == 200:
-            primary_image_data = BytesIO(await primary_image_response.read())
-            primary_image_data.seek(0)
-            primary_file = discord.File(fp=primary_image_data, filename='primary_image.jpg')
-            primary_image_url = "attachment://primary_image.jpg"
-        else:
-            primary_file = discord.File('./ASSETS/Series_Missing.jpg', filename='Series_Missing.jpg')
-            primary_image_url = "attachment://Series_Missing.jpg"
+    # Fetch the primary and backdrop images side by side
+    backdrop_tags = item.get('BackdropImageTags') or [None]
+    primary_image_bytes, backdrop_image_bytes = await asyncio.gather(
+        fetch_artwork(emby, item_id, 'Primary', item.get('ImageTags', {}).get('Primary'), slot='thumbnail'),
+        fetch_artwork(emby, item_id, 'Backdrop/0', backdrop_tags[0], slot='backdrop'),
+    )
+    if primary_image_bytes:
+        thumbnail = ('primary_image.jpg', primary_image_bytes)
+    else:
+        thumbnail = ('Series_Missing.jpg', load_asset('Series_Missing.jpg'))
 
-        embed = discord.Embed(title=f"{title} ({year})", description=item.get('Overview', 'No overview available'), color=discord.Color.blue())
-        embed.set_thumbnail(url=primary_image_url)
+    embed = discord.Embed(title=f"{title} ({year})", description=item.get('Overview', 'No overview available'), color=discord.Color.blue())
+    embed.set_thumbnail(url=f"attachment://{thumbnail[0]}")
 
-        # Delete the previous embed message for the user, if any
-        if 'last_embed_message' in last_user_info[username] and last_user_info[username]['last_embed_message']:
-            try:
-                await last_user_info[username]['last_embed_message'].delete()
-            except discord.HTTPException as e:
-                print(f"Failed to delete movie embed message: {e}")
-            last_user_info[username]['last_embed_message'] = None
-
-        # Send the new embed message with the primary image thumbnail
-        new_embed_message = await bot.now_playing_thread.send(embed=embed, file=primary_file)
-        last_user_info[username]['last_embed_message'] = new_embed_message
-
-        # Fetch and send the backdrop image as a separate message
-        backdrop_image_response = await session.get(backdrop_image_url)
-        if backdrop_image_response.status == 200:
-            backdrop_image_data = BytesIO(await backdrop_image_response.read())
-            backdrop_image_data.seek(0)
-            backdrop_file = discord.File(fp=backdrop_image_data, filename='backdrop_image.jpg')
-            new_image_message = await bot.now_playing_thread.send(file=backdrop_file)
-            last_user_info[username]['last_image_message'] = new_image_message  # Track the new image message
-
-    # Update the bot's status message
-    new_status = f"{title} ({year})"
-    await bot.change_presence(activity=discord.Game(name=new_status))
-    print(f"Updated bot status to: {new_status}")
-    
-async def handle_audio(bot, item, emby_server_ip, emby_server_port, api_key, username):
-    global last_user_info
-
-    # Initialize last_user_info for the user if not already done
-    if username not in last_user_info:
-        last_user_info[username] = {
-            'last_item_id': None,
-            'last_embed_message': None,
-            'last_image_message': None
-        }
+    # The backdrop image goes in a separate message
+    backdrop = ('backdrop_image.jpg', backdrop_image_bytes) if backdrop_image_bytes else None
 
+    return NowPlayingView(embed, thumbnail, backdrop, status=f"{title} ({year})",
+                          tags=(item.get('ImageTags', {}).get('Primary') if primary_image_bytes else None, backdrop_tags[0]),
+                          media_type='movie',
+                          keys=(artwork_key(emby, item_id, 'Primary', item.get('ImageTags', {}).get('Primary'), 'thumbnail') if primary_image_bytes else None,
+                                artwork_key(emby, item_id, 'Backdrop/0', backdrop_tags[0], 'backdrop')))
+    
+async def build_audio_view(item, emby):
     # Extract details from the item
     title = item.get('Name', 'Unknown Title')
     artists = item.get('Artists', ['Unknown Artist'])
@@ -484,186 +2986,76 @@ async def handle_audio(bot, item, emby_server_ip, emby_server_port, api_key, use
     album_id = item.get('AlbumId')  # Ensuring album_id is extracted from the item
     year = item.get('ProductionYear', 'Unknown Year')  # Extracting the year
 
-    # Prepare to fetch artist thumbnail
-    artist_thumbnail_file = None
+    # Fetch the artist thumbnail and album cover side by side
     artist_id = item.get('ArtistItems', [{}])[0].get('Id', None)  # Safely getting the artist ID
-    if artist_id:
-        artist_thumbnail_url = f"http://{emby_server_ip}:{emby_server_port}/emby/Items/{artist_id}/Images/Primary?api_key={api_key}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(artist_thumbnail_url) as response:
-                if response.status == 200:
-                    artist_thumbnail_data = BytesIO(await response.read())
-                    artist_thumbnail_data.seek(0)
-                    artist_thumbnail_file = discord.File(artist_thumbnail_data, filename='artist_thumbnail.jpg')
-
-    # Prepare to fetch album cover image
-    album_cover_file = None
-    if album_id:  # Ensure album_id is not None
-        album_cover_url = f"http://{emby_server_ip}:{emby_server_port}/emby/Items/{album_id}/Images/Primary?api_key={api_key}"
-        async with aiohttp.ClientSession() as session:
-            async with session.get(album_cover_url) as response:
-                if response.status == 200:
-                    album_cover_data = BytesIO(await response.read())
-                    album_cover_data.seek(0)
-                    album_cover_file = discord.File(album_cover_data, filename='album_cover.jpg')
-
-    # Delete previous messages if they exist
-    if 'last_embed_message' in last_user_info[username] and last_user_info[username]['last_embed_message']:
-        try:
-            await last_user_info[username]['last_embed_message'].delete()
-        except discord.NotFound:
-            pass  # If the message is already deleted or not found, just pass
-        last_user_info[username]['last_embed_message'] = None
-
-    if 'last_image_message' in last_user_info[username] and last_user_info[username]['last_image_message']:
-        try:
-            await last_user_info[username]['last_image_message'].delete()
-        except discord.NotFound:
-            pass  # If the message is already deleted or not found, just pass
-        last_user_info[username]['last_image_message'] = None
+    artist_thumbnail_bytes, album_cover_bytes = await asyncio.gather(
+        fetch_artwork(emby, artist_id, 'Primary', slot='thumbnail') if artist_id else no_artwork(),
+        fetch_artwork(emby, album_id, 'Primary', item.get('AlbumPrimaryImageTag'), slot='image') if album_id else no_artwork(),
+    )
+    artist_thumbnail = ('artist_thumbnail.jpg', artist_thumbnail_bytes) if artist_thumbnail_bytes else None
+    album_cover = ('album_cover.jpg', album_cover_bytes) if album_cover_bytes else None
 
     # Create the embed for the audio with description formatting
     embed = discord.Embed(title=title, color=discord.Color.blue())
     embed_description = f"**Artist:** {artist_name}\n**Album:** {album}\n**Year:** {year}"
     embed.description = embed_description
-    if artist_thumbnail_file:
+    if artist_thumbnail:
         embed.set_thumbnail(url="attachment://artist_thumbnail.jpg")
-        
-    # Send the embed message with artist thumbnail
-    new_embed_message = await bot.now_playing_thread.send(file=artist_thumbnail_file, embed=embed) if artist_thumbnail_file else await bot.now_playing_thread.send(embed=embed)
-    last_user_info[username]['last_embed_message'] = new_embed_message
 
-    # If album cover file is available, send it as a separate message
-    if album_cover_file:
-        new_image_message = await bot.now_playing_thread.send(file=album_cover_file)
-        last_user_info[username]['last_image_message'] = new_image_message
-
-    # Update the bot's status message
-    await bot.change_presence(activity=discord.Game(name=f"{artist_name}: {title}"))
+    # The album cover, if available, goes in a separate message
+    return NowPlayingView(embed, artist_thumbnail, album_cover, status=f"{artist_name}: {title}",
+                          tags=(None, item.get('AlbumPrimaryImageTag')), media_type='audio',
+                          keys=(None, artwork_key(emby, album_id, 'Primary', item.get('AlbumPrimaryImageTag'), 'image') if album_id else None))
 
     
 
-async def handle_music_video(bot, item, emby_server_ip, emby_server_port, api_key, username):
-    global last_user_info
-
-    # Call this function to clear the "Nothing Playing" message before proceeding
-    await clear_nothing_playing_message()
+async def build_music_video_view(item, emby):
+    current_item_id = item.get('Id')
 
-    try:
-        discord_file = None  # Ensure discord_file is defined at the start
-        current_item_id = item.get('Id') if item else None
-        current_time = datetime.utcnow()
-
-        # Retrieve the last update time and item ID for the user
-        last_update_time = last_user_info[username].get('last_update_time', datetime.utcfromtimestamp(0))
-        last_item_id = last_user_info[username].get('last_item_id')
-
-        if not item or (last_item_id == current_item_id and current_time - last_update_time < timedelta(seconds=10)):
-            return
-
-        # Attempt to delete previous messages if they exist
-        if 'last_embed_message' in last_user_info[username] and last_user_info[username]['last_embed_message']:
-            try:
-                await last_user_info[username]['last_embed_message'].delete()
-            except Exception as e:
-                print(f"Failed to delete embed message: {e}")
-        if 'last_image_message' in last_user_info[username] and last_user_info[username]['last_image_message']:
-            try:
-                await last_user_info[username]['last_image_message'].delete()
-            except Exception as e:
-                print(f"Failed to delete image message: {e}")
-
-        full_title = item.get('Name', 'Unknown Music Video')
-        artist, song_title = full_title.split(" - ", 1) if " - " in full_title else ("Unknown Artist", full_title)
-        year = item.get('ProductionYear', 'Unknown Year')
-        image_tag = item.get('ImageTags', {}).get('Primary', '')
-
-        poster_image_url = f"http://{emby_server_ip}:{emby_server_port}/emby/Items/{current_item_id}/Images/Primary?tag={image_tag}&api_key={api_key}"
-
-        # Update for artist_id definition based on your item structure
-        artist_id = item.get('ArtistItems', [{}])[0].get('Id', '') if item.get('ArtistItems') else ''
-
-        artist_image_url = f"http://{emby_server_ip}:{emby_server_port}/emby/Items/{artist_id}/Images/Primary?api_key={api_key}" if artist_id else ''
-
-        description = f"**Artist:** {artist}\n**Title:** {song_title}\n**Year:** {year}"
-        embed = discord.Embed(title="Music Video", description=description, color=discord.Color.blue())
-        embed.set_image(url=poster_image_url)  # Set the main video poster as the embed image
+    full_title = item.get('Name', 'Unknown Music Video')
+    artist, song_title = full_title.split(" - ", 1) if " - " in full_title else ("Unknown Artist", full_title)
+    year = item.get('ProductionYear', 'Unknown Year')
+    image_tag = item.get('ImageTags', {}).get('Primary', '')
 
-        if artist_image_url:
-            response = requests.get(artist_image_url)
-            if response.status_code == 200:
-                temp_dir = tempfile.mkdtemp()
-                artist_image_path = os.path.join(temp_dir, 'artist_thumbnail.jpg')
-                with open(artist_image_path, 'wb') as image_file:
-                    image_file.write(response.content)
-                discord_file = discord.File(fp=artist_image_path, filename='artist_thumbnail.jpg')
-                embed.set_thumbnail(url="attachment://artist_thumbnail.jpg")
-            else:
-                print("Failed to download artist image.")
+    poster_image_url = emby.url(f"/emby/Items/{current_item_id}/Images/Primary", tag=image_tag)
 
-        new_embed_message = await bot.now_playing_thread.send(file=discord_file if discord_file else None, embed=embed)
-        last_user_info[username]['last_embed_message'] = new_embed_message
+    # Update for artist_id definition based on your item structure
+    artist_id = item.get('ArtistItems', [{}])[0].get('Id', '') if item.get('ArtistItems') else ''
 
-        async with aiohttp.ClientSession() as session:
-            async with session.get(poster_image_url) as response:
-                if response.status == 200:
-                    image_data = await response.read()
-                    image_bytes = io.BytesIO(image_data)
-                    image_bytes.seek(0)
-                    new_image_message = await bot.now_playing_thread.send(file=discord.File(fp=image_bytes, filename='primary_image.jpg'))
-                    last_user_info[username]['last_image_message'] = new_image_message
+    description = f"**Artist:** {artist}\n**Title:** {song_title}\n**Year:** {year}"
+    embed = discord.Embed(title="Music Video", description=description, color=discord.Color.blue())
+    embed.set_image(url=poster_image_url)  # Set the main video poster as the embed image
 
-        last_user_info[username]['last_item_id'] = current_item_id
-        last_user_info[username]['last_update_time'] = current_time
+    artist_image_data, image_data = await asyncio.gather(
+        fetch_artwork(emby, artist_id, 'Primary', slot='thumbnail') if artist_id else no_artwork(),
+        fetch_artwork(emby, current_item_id, 'Primary', image_tag or None, slot='image'),
+    )
 
-        new_status = f"{artist} - {song_title}"
-        await bot.change_presence(activity=discord.Game(name=new_status))
+    artist_thumbnail = None
+    if artist_image_data:
+        artist_thumbnail = ('artist_thumbnail.jpg', artist_image_data)
+        embed.set_thumbnail(url="attachment://artist_thumbnail.jpg")
+    elif artist_id:
+        log.warning("Failed to download artist image", extra={'artist_id': artist_id})
 
-    except Exception as e:
-        print(f"An error occurred while handling music video: {str(e)}")
+    poster = ('primary_image.jpg', image_data) if image_data else None
 
-    # Clean up the temporary directory after sending the message
-    if discord_file:
-        os.remove(artist_image_path)
-        os.rmdir(temp_dir)
+    return NowPlayingView(embed, artist_thumbnail, poster, status=f"{artist} - {song_title}", tags=(None, image_tag or None),
+                          media_type='musicvideo', keys=(None, artwork_key(emby, current_item_id, 'Primary', image_tag, 'image')))
 
 
-async def handle_audio_book(bot, item, username):
+def build_audio_book_view(item):
     title = item.get('Name', 'Unknown Audio Book')
     embed = discord.Embed(title=title, description="Currently listening to an audiobook.", color=discord.Color.blue())
-    await update_or_send_new_message(bot, embed, username)
+    return NowPlayingView(embed)
 
-async def handle_generic_media(bot, item, username, media_type):
+def build_generic_media_view(item, media_type):
     title = item.get('Name', f'Unknown {media_type}')
     embed = discord.Embed(title=title, description=f"Currently watching/listening to {media_type}.", color=discord.Color.blue())
-    await update_or_send_new_message(bot, embed, username)
-
-async def update_or_send_new_message(bot, embed, username):
-    global last_user_info
-
-    # Check and initialize user info if not present
-    if username not in last_user_info:
-        last_user_info[username] = {
-            'last_item_id': None,
-            'last_embed_message': None,  # Ensure this is in place for new tracking
-        }
+    return NowPlayingView(embed)
 
-    # Use last_embed_message 
-    last_embed_message = last_user_info[username].get('last_embed_message')
-    if last_embed_message:
-        try:
-            # Attempt to edit the existing embed message
-            await last_embed_message.edit(embed=embed)
-            print(f"Edited embed message for {username}.")
-        except discord.NotFound:
-            # If the message cannot be found (deleted manually, etc.), send a new one
-            new_embed_message = await bot.now_playing_thread.send(embed=embed)
-            last_user_info[username]['last_embed_message'] = new_embed_message
-            print(f"Sent new embed message for {username} (edit failed).")
-    else:
-        # If there's no previous message, send a new one
-        new_embed_message = await bot.now_playing_thread.send(embed=embed)
-        last_user_info[username]['last_embed_message'] = new_embed_message  # Update to track this new message
-        print(f"Sent new embed message for {username}.")
+servers = load_servers()
 
-bot.run(discord_bot_token)
\ No newline at end of file
+if __name__ == '__main__':
+    configure_logging()
+    bot.run(discord_bot_token)
@@ -0,0 +1,549 @@
+# End-to-end benchmark for NOWPLAYING.py.
+#
+# Runs the real session processing, artwork, rendering and outbox code against a local stand-in Emby
+# server (aiohttp) and a fake Discord thread that counts every call, then reports poll-to-post latency
+# percentiles, Discord/Emby call counts per track change and peak RSS.
+#
+#   python bench/bench_nowplaying.py                      # all built-in scenarios
+#   python bench/bench_nowplaying.py --scenario playlist_skip --scenario idle_flapping
+#   python bench/bench_nowplaying.py --replay recorded_sessions.json
+#   python bench/bench_nowplaying.py --scenario websocket           # pushed sessions, drop, poll fallback, reconnect
+#
+# A replay file is a JSON list of /Sessions payloads (one per poll), e.g. captured with
+#   curl -H "X-Emby-Token: $EMBY_API_BOT_KEY" http://emby:8096/Sessions
+# Image requests in a replay are answered with generated images.
+
+import os
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import resource
+import tempfile
+import itertools
+import logging
+from io import BytesIO
+from collections import Counter
+
+# The bot reads its configuration at import time, so point it at throwaway locations first
+bench_dir = tempfile.mkdtemp(prefix='nowplaying-bench-')
+os.environ.setdefault('EMBY_THREAD_CHANNEL', '1')
+os.environ.setdefault('NOWPLAYING_INGEST_MODE', 'poll')
+os.environ.setdefault('NOWPLAYING_STATE_DB', os.path.join(bench_dir, 'state.sqlite3'))
+os.environ.setdefault('NOWPLAYING_ARTWORK_CACHE_DIR', os.path.join(bench_dir, 'artwork'))
+os.environ.setdefault('NOWPLAYING_HISTORY_LOG', os.path.join(bench_dir, 'history.jsonl'))
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import discord
+from aiohttp import web, WSMsgType
+
+import NOWPLAYING as np
+
+
+# --- Fake Discord transport ---
+
+message_ids = itertools.count(discord.utils.time_snowflake(discord.utils.utcnow()))
+
+
+class FakeAttachment:
+    def __init__(self, message_id, index, filename):
+        # Signed like Discord's CDN URLs, with the expiry as a hex timestamp in 'ex'
+        self.url = f"https://cdn.example/attachments/{message_id}/{index}/{filename}?ex={int(time.time()) + 86400:x}"
+
+
+class FakeMessage:
+    # Doubles as Message and PartialMessage; edits with files go through _state.http like the real ones
+    def __init__(self, thread, message_id=None, files=()):
+        self.id = message_id or next(message_ids)
+        self.thread = thread
+        self.channel = thread
+        self._state = self
+        self.http = self
+        self.attachments = [FakeAttachment(self.id, index, file.filename) for index, file in enumerate(files)]
+
+    async def edit_files(self, channel_id, message_id, files, **fields):
+        self.thread.count_upload(files)
+        await self.thread.record('edit')
+
+    async def edit(self, **fields):
+        await self.thread.record('edit')
+        return self
+
+    async def delete(self, **fields):
+        await self.thread.record('delete')
+
+    async def pin(self, **fields):
+        await self.thread.record('pin')
+
+
+class FakeThread:
+    # Stands in for bot.now_playing_thread; every REST call is counted and timestamped
+    def __init__(self, latency):
+        self.id = 0
+        self.latency = latency  # Simulated Discord round-trip in seconds
+        self.calls = Counter()
+        self.upload_bytes = 0
+        self.last_call_at = None
+
+    def count_upload(self, files):
+        self.upload_bytes += sum(len(file.fp.getvalue()) for file in files if hasattr(file.fp, 'getvalue'))
+
+    async def record(self, kind):
+        self.calls[kind] += 1
+        await asyncio.sleep(self.latency)
+        if kind != 'presence':  # Presence is paced separately and isn't part of getting the post out
+            self.last_call_at = time.perf_counter()
+
+    async def send(self, embed=None, file=None, files=None, **fields):
+        files = [file] if file is not None else list(files or [])
+        self.count_upload(files)
+        await self.record('send')
+        return FakeMessage(self, files=files)
+
+    async def fetch_message(self, message_id):
+        await self.record('fetch')
+        raise discord.NotFound(FakeResponse(404), 'Unknown Message')
+
+    def get_partial_message(self, message_id):
+        return FakeMessage(self, message_id)
+
+    async def delete_messages(self, messages):
+        await self.record('bulk_delete')
+
+    def history(self, **fields):
+        return FakeHistory()
+
+
+class FakeHistory:
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        raise StopAsyncIteration
+
+
+class FakeResponse:
+    def __init__(self, status):
+        self.status = status
+        self.reason = 'fake'
+        self.headers = {}
+
+
+class FakeBot:
+    def __init__(self, thread):
+        self.thread = thread
+        self.user = object()
+
+    async def change_presence(self, **fields):
+        await self.thread.record('presence')
+
+
+# --- Stand-in Emby server ---
+
+def generate_jpeg(size):
+    # A noise JPEG of roughly `size` bytes, so the downscaling path does real work. Without Pillow the bot
+    # uploads artwork as-is anyway, and random bytes are as incompressible as real JPEG data.
+    try:
+        from PIL import Image
+    except ImportError:
+        return random.randbytes(size)
+    side = 64
+    while True:
+        buffer = BytesIO()
+        Image.effect_noise((side, side), 64).convert('RGB').save(buffer, format='JPEG', quality=90)
+        if buffer.tell() >= size or side >= 8192:
+            return buffer.getvalue()
+        side = min(8192, int(side * max(1.1, (size / buffer.tell()) ** 0.5)))
+
+
+class FakeEmby:
+    def __init__(self, image_size):
+        self.sessions = []
+        self.items = {}
+        self.image_size = image_size
+        self.image_cache = {}
+        self.requests = Counter()
+        self.runner = None
+        self.port = None
+        self.websockets = set()  # Open /embywebsocket connections that have sent SessionsStart
+        self.websocket_refused = False  # Answer upgrade requests with 503, as a restarting server would
+
+    def image(self, size):
+        if size not in self.image_cache:
+            self.image_cache[size] = generate_jpeg(size)
+        return self.image_cache[size]
+
+    @web.middleware
+    async def count_requests(self, request, handler):
+        self.requests[request.path.split('/')[-1] if '/Images/' not in request.path else 'image'] += 1
+        return await handler(request)
+
+    async def get_sessions(self, request):
+        return web.json_response(self.sessions)
+
+    async def get_websocket(self, request):
+        if self.websocket_refused:
+            return web.Response(status=503)
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        try:
+            async for msg in ws:
+                if msg.type == WSMsgType.TEXT and json.loads(msg.data).get('MessageType') == 'SessionsStart':
+                    self.websockets.add(ws)
+        finally:
+            self.websockets.discard(ws)
+        return ws
+
+    async def push_sessions(self, payload):
+        # What Emby sends subscribers whenever the session list changes
+        self.sessions = payload
+        for ws in list(self.websockets):
+            await ws.send_json({'MessageType': 'Sessions', 'Data': payload})
+
+    async def drop_websockets(self):
+        self.websocket_refused = True
+        for ws in list(self.websockets):
+            await ws.close()
+
+    async def get_image(self, request):
+        item = self.items.get(request.match_info['item_id'], {})
+        return web.Response(body=self.image(item.get('bench_image_size', self.image_size)), content_type='image/jpeg')
+
+    async def get_user_item(self, request):
+        item = self.items.get(request.match_info['item_id'])
+        return web.json_response(item) if item else web.Response(status=404)
+
+    async def get_user_items(self, request):
+        album_id = request.query.get('ParentId')
+        tracks = [item for item in self.items.values() if item.get('AlbumId') == album_id]
+        tracks.sort(key=lambda item: item.get('IndexNumber', 0))
+        return web.json_response({'Items': tracks, 'TotalRecordCount': len(tracks)})
+
+    async def get_artists(self, request):
+        return web.json_response({'Items': [], 'TotalRecordCount': 0})
+
+    async def start(self):
+        app = web.Application(middlewares=[self.count_requests])
+        app.router.add_get('/Sessions', self.get_sessions)
+        app.router.add_get('/embywebsocket', self.get_websocket)
+        app.router.add_get('/emby/Items/{item_id}/Images/{image_type:.+}', self.get_image)
+        app.router.add_get('/Users/{user_id}/Items/{item_id}', self.get_user_item)
+        app.router.add_get('/Users/{user_id}/Items', self.get_user_items)
+        app.router.add_get('/emby/Artists', self.get_artists)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, '127.0.0.1', 0)
+        await site.start()
+        self.port = site._server.sockets[0].getsockname()[1]
+
+    async def stop(self):
+        await self.runner.cleanup()
+
+
+# --- Scenario data ---
+
+def audio_item(index, album=0):
+    return {
+        'Id': f'track-{album}-{index}',
+        'Type': 'Audio',
+        'Name': f'Track {index}',
+        'Artists': [f'Artist {album}'],
+        'ArtistItems': [{'Id': f'artist-{album}'}],
+        'Album': f'Album {album}',
+        'AlbumId': f'album-{album}',
+        'AlbumPrimaryImageTag': f'album-tag-{album}',
+        'IndexNumber': index,
+        'ProductionYear': 2000,
+        'RunTimeTicks': 180 * 10_000_000,
+    }
+
+
+def movie_item(index, image_size=None):
+    item = {
+        'Id': f'movie-{index}',
+        'Type': 'Movie',
+        'Name': f'Movie {index}',
+        'ProductionYear': 2000 + index,
+        'Overview': 'A film.',
+        'ImageTags': {'Primary': f'primary-{index}'},
+        'BackdropImageTags': [f'backdrop-{index}'],
+        'RunTimeTicks': 7200 * 10_000_000,
+    }
+    if image_size:
+        item['bench_image_size'] = image_size
+    return item
+
+
+def session(username, item, position_ticks=0):
+    return {
+        'UserName': username,
+        'UserId': f'user-{username}',
+        'NowPlayingItem': item,
+        'PlayState': {'PositionTicks': position_ticks, 'IsPaused': False},
+    }
+
+
+# A scenario is a list of steps: (sessions payload, settle) where settle means wait for every queued
+# Discord operation to finish before the next poll; unsettled steps model polls arriving mid-burst.
+
+def scenario_playlist_skip():
+    steps = []
+    for burst in range(5):
+        for track in range(6):
+            steps.append(([session('tim', audio_item(burst * 6 + track))], track == 5))
+    return ['tim'], steps
+
+
+def scenario_many_users(user_count=30, rounds=5):
+    users = [f'user{i}' for i in range(user_count)]
+    steps = []
+    for round_number in range(rounds):
+        payload = [session(user, audio_item(round_number, album=i)) for i, user in enumerate(users)]
+        steps.append((payload, True))
+    return users, steps
+
+
+def scenario_idle_flapping(cycles=10):
+    steps = []
+    for cycle in range(cycles):
+        steps.append(([session('tim', audio_item(cycle))], True))
+        steps.append(([], True))
+    return ['tim'], steps
+
+
+def scenario_large_artwork(changes=5, image_size=8 * 1024 * 1024):
+    steps = [([session('tim', movie_item(i, image_size))], True) for i in range(changes)]
+    return ['tim'], steps
+
+
+def scenario_websocket(pushed=5, polled=3):
+    # Track changes pushed over the WebSocket, then the socket drops and stays refused so the same kind of
+    # changes have to come in by polling, then Emby takes connections again and pushing resumes
+    tracks = (session('tim', audio_item(index)) for index in itertools.count())
+    steps = [([next(tracks)], True) for _ in range(pushed)]
+    steps.append('drop')
+    steps += [([next(tracks)], True) for _ in range(polled)]
+    steps.append('reconnect')
+    steps += [([next(tracks)], True) for _ in range(pushed)]
+    return ['tim'], steps
+
+
+def scenario_replay(path):
+    with open(path, 'r', encoding='utf-8') as f:
+        frames = json.load(f)
+    users = sorted({s.get('UserName', '').lower() for frame in frames for s in frame if s.get('NowPlayingItem')})
+    return users, [(frame, True) for frame in frames]
+
+
+scenarios = {
+    'playlist_skip': scenario_playlist_skip,
+    'many_users': scenario_many_users,
+    'idle_flapping': scenario_idle_flapping,
+    'large_artwork': scenario_large_artwork,
+    'websocket': scenario_websocket,
+}
+
+# Scenarios fed through the bot's Emby WebSocket listener rather than its poll
+websocket_scenarios = {'websocket'}
+
+
+# --- Runner ---
+
+def make_server(users, emby_client, thread, debounce, dashboard_interval):
+    # A fresh server per scenario, so no posts, state or cached artwork carry over between scenarios
+    work_dir = tempfile.mkdtemp(dir=bench_dir)
+    cadence = np.PollCadence(np.poll_interval_min, np.poll_interval_active, np.poll_interval_max,
+                             np.poll_idle_backoff, np.poll_end_margin)
+    server = np.EmbyServer('bench', emby_client, 0, users, [], cadence,
+                           np.StateStore(os.path.join(work_dir, 'state.sqlite3')), 'poll')
+    server.thread = thread
+    server.outbox = np.DiscordOutbox(thread, server.message_registry, debounce)
+    server.dashboard = np.Dashboard(dashboard_interval)
+    np.servers = [server]
+    np.artwork_cache = np.ArtworkCache(os.path.join(work_dir, 'artwork'), np.artwork_memory_cache_bytes,
+                                       np.artwork_disk_cache_bytes, np.artwork_untagged_ttl)
+    np.bot = FakeBot(thread)
+    np.presence_manager = np.PresenceManager(np.presence_user_priority, np.presence_media_priority, np.presence_rate_limit)
+    return server
+
+
+async def wait_until_idle(server):
+    outbox = server.outbox
+    while outbox.pending or (outbox.flush_task and not outbox.flush_task.done()) or any(
+            task and not task.done() for task in list(server.prefetch_tasks.values()) + [server.dashboard.task]):
+        await asyncio.sleep(0.005)
+
+
+async def wait_for(condition, what, timeout=10):
+    # The WebSocket scenario checks the bot really switched ingestion; a phase that never happens fails the run
+    deadline = time.perf_counter() + timeout
+    while not condition():
+        if time.perf_counter() > deadline:
+            raise RuntimeError(f"Timed out waiting for {what}")
+        await asyncio.sleep(0.005)
+
+
+def posted(server, payload):
+    return all(server.user_state(s['UserName'].lower()).item_id == s['NowPlayingItem']['Id'] for s in payload)
+
+
+def percentile(values, fraction):
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(fraction * (len(ordered) - 1))))]
+
+
+async def run_scenario(name, users, steps, emby, emby_client, discord_latency, debounce, dashboard_interval, artwork_store,
+                       ingest='poll'):
+    thread = FakeThread(discord_latency)
+    server = make_server(users, emby_client, thread, debounce, dashboard_interval)
+    server.ingest_mode = ingest
+    np.artwork_store = np.ArtworkStore(1, np.artwork_store_capacity, np.artwork_url_margin, np.artwork_url_ttl)
+    if artwork_store:
+        np.artwork_store.start(thread)  # Uploads are counted with the rest of the thread's calls
+    emby.items = {}
+    for step in steps:
+        for s in step[0] if not isinstance(step, str) else []:
+            emby.items[s['NowPlayingItem']['Id']] = s['NowPlayingItem']
+    emby.requests.clear()
+    emby.websocket_refused = False
+
+    listener = None
+    if ingest == 'websocket':
+        np.websocket_reconnect_delay = np.websocket_max_reconnect_delay = 0.1
+        listener = asyncio.create_task(np.emby_websocket_listener(server))
+        await wait_for(lambda: server.websocket_connected and emby.websockets, 'the WebSocket to connect')
+
+    latencies = []
+    changes = 0
+    previous = {}
+    burst_started = None
+    for step in steps:
+        if step == 'drop':
+            await emby.drop_websockets()
+            await wait_for(lambda: not server.websocket_connected, 'the bot to notice the dropped WebSocket')
+            continue
+        if step == 'reconnect':
+            emby.websocket_refused = False
+            await wait_for(lambda: server.websocket_connected and emby.websockets, 'the WebSocket to reconnect')
+            continue
+
+        payload, settle = step
+        current = {s['UserName']: s['NowPlayingItem']['Id'] for s in payload if s.get('NowPlayingItem')}
+        changes += sum(1 for user, item_id in current.items() if previous.get(user) != item_id)
+        previous = current
+
+        if burst_started is None:
+            burst_started = time.perf_counter()
+        if listener is not None and server.websocket_connected:
+            # The poll still fires on schedule but has to stand down while the socket is up
+            polls = emby.requests['Sessions']
+            await emby.push_sessions(payload)
+            await np.now_playing_check(server)
+            if emby.requests['Sessions'] != polls:
+                raise RuntimeError("Polled /Sessions while the WebSocket was connected")
+            await wait_for(lambda: posted(server, payload), 'the pushed sessions to be handled')
+        else:
+            emby.sessions = payload
+            await np.now_playing_check(server)
+        if settle:
+            thread.last_call_at = None
+            await wait_until_idle(server)
+            if thread.last_call_at is not None:
+                latencies.append((thread.last_call_at - burst_started) * 1000)
+            burst_started = None
+        else:
+            await asyncio.sleep(0.05)
+
+    if listener is not None:
+        listener.cancel()
+        await asyncio.gather(listener, return_exceptions=True)
+    if np.presence_manager.task:
+        await np.presence_manager.task
+    discord_calls = sum(thread.calls.values())
+    return {
+        'scenario': name,
+        'changes': changes,
+        'p50_ms': percentile(latencies, 0.50),
+        'p95_ms': percentile(latencies, 0.95),
+        'p99_ms': percentile(latencies, 0.99),
+        'discord_calls': dict(thread.calls),
+        'upload_mb': thread.upload_bytes / (1024 * 1024),
+        'discord_per_change': discord_calls / changes if changes else 0.0,
+        'emby_requests': dict(emby.requests),
+        'artwork_cache': np.artwork_cache.stats(),
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+    }
+
+
+def print_report(results):
+    header = (f"{'scenario':<15}{'changes':>8}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'discord':>9}{'/change':>9}"
+              f"{'upload MB':>11}{'emby':>7}{'rss MB':>9}")
+    print(header)
+    print('-' * len(header))
+    for r in results:
+        print(f"{r['scenario']:<15}{r['changes']:>8}{r['p50_ms']:>10.1f}{r['p95_ms']:>10.1f}{r['p99_ms']:>10.1f}"
+              f"{sum(r['discord_calls'].values()):>9}{r['discord_per_change']:>9.2f}{r['upload_mb']:>11.2f}"
+              f"{sum(r['emby_requests'].values()):>7}{r['peak_rss_mb']:>9.1f}")
+    print()
+    for r in results:
+        print(f"{r['scenario']}: discord {r['discord_calls']} emby {r['emby_requests']} cache {r['artwork_cache']}")
+
+
+async def main():
+    parser = argparse.ArgumentParser(description='Benchmark NOWPLAYING.py against a fake Emby server and Discord thread.')
+    parser.add_argument('--scenario', action='append', choices=sorted(scenarios), help='Scenario to run (repeatable, default all)')
+    parser.add_argument('--replay', help='JSON file with a recorded list of /Sessions payloads')
+    parser.add_argument('--image-size', type=int, default=200 * 1024, help='Bytes per generated image (default 200 KiB)')
+    parser.add_argument('--discord-latency', type=float, default=0.03, help='Simulated Discord round-trip in seconds')
+    parser.add_argument('--debounce', type=float, default=0.2, help='Outbox debounce window in seconds (the bot defaults to 2)')
+    parser.add_argument('--dashboard-interval', type=float, default=1.0, help='Minimum seconds between dashboard updates')
+    parser.add_argument('--render-mode', choices=['messages', 'card', 'dashboard'], default=np.render_mode, help='Post layout to benchmark')
+    parser.add_argument('--artwork-store', action='store_true', help='Upload artwork once and post its CDN URL (NOWPLAYING_ARTWORK_CHANNEL)')
+    parser.add_argument('--verbose', action='store_true', help="Show the bot's own log output while scenarios run")
+    parser.add_argument('--json', action='store_true', help='Print results as JSON')
+    args = parser.parse_args()
+
+    np.render_mode = args.render_mode
+
+    emby = FakeEmby(args.image_size)
+    await emby.start()
+    emby_client = np.EmbyClient('127.0.0.1', emby.port, 'bench', name='bench')
+
+    runs = []
+    if args.replay:
+        runs.append(('replay',) + scenario_replay(args.replay))
+    for name in args.scenario or ([] if args.replay else sorted(scenarios)):
+        runs.append((name,) + scenarios[name]())
+
+    # The bot logs through the 'nowplaying' logger; without a handler of its own, warnings would still reach
+    # stderr through logging's last-resort handler
+    if args.verbose:
+        np.configure_logging()
+    else:
+        np.log.addHandler(logging.NullHandler())
+        np.log.propagate = False
+
+    results = []
+    try:
+        for name, users, steps in runs:
+            results.append(await run_scenario(name, users, steps, emby, emby_client, args.discord_latency,
+                                               args.debounce, args.dashboard_interval, args.artwork_store,
+                                               'websocket' if name in websocket_scenarios else 'poll'))
+    finally:
+        await emby_client.close()
+        await emby.stop()
+        if np.artwork_process_pool is not None:
+            np.artwork_process_pool.shutdown()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+    else:
+        print_report(results)
+
+
+if __name__ == '__main__':
+    asyncio.run(main())